@@ -1,108 +1,384 @@
+import os
+from ConfiguracaoThreads import NUM_THREADS_FAISS # Antes de numpy/faiss/torch
 import sys
-import json
+
+# Modo worker (--serve): o stdout fica reservado ao protocolo JSON. As mensagens
+# de progresso, inclusive as da importação do modelo (ModeloEmbedding.py),
+# vão para o stderr desde antes dos imports pesados.
+_SAIDA_PROTOCOLO = sys.stdout
+if __name__ == "__main__" and sys.argv[1:] == ["--serve"]:
+    sys.stdout = sys.stderr
+
+import mmap
+import contextlib
+import time
+import pickle
+import hashlib
 import numpy as np
 import faiss
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, Union
 
 # =====================================================================
 # ETAPA 0: Importação e Configuração FAISS
 # =====================================================================
 try:
-    from sentence_transformers import SentenceTransformer
     import faiss
-    import torch # Importar apenas se for necessário para checagem de device
+    faiss.omp_set_num_threads(NUM_THREADS_FAISS) # Evita disputa de threads com o PyTorch
+    import orjson # Parser JSON rápido para os metadados
 
     # 🌟 MODELO BERT LEVE 🌟 (O mesmo usado para criar o índice)
-    # ATENÇÃO: É VITAL USAR O MESMO MODELO USADO EM Legislacao.py!
-    MODELO_EMBEDDING = SentenceTransformer('all-MiniLM-L6-v2') 
-    
-    # Define o dispositivo de execução (importante para performance)
-    device = "cuda" if torch.cuda.is_available() else "cpu"
-    MODELO_EMBEDDING.to(device) 
-    
-    print(f"✅ Modelo de Embedding carregado no dispositivo: {device}")
+    # O carregamento, o dispositivo (CPU/GPU) e a precisão ficam em ModeloEmbedding.py,
+    # garantindo que Legislacao.py e BuscaFaiss.py usem exatamente o mesmo modelo.
+    from ModeloEmbedding import gerar_embeddings
 except ImportError:
-    print("❌ ERRO: Bibliotecas de embedding/FAISS não instaladas. Use: pip install torch sentence-transformers numpy faiss-cpu")
+    print("❌ ERRO: Bibliotecas de embedding/FAISS não instaladas. Use: pip install torch sentence-transformers numpy faiss-cpu orjson")
     sys.exit(1)
 
+# Amplitude da busca no grafo HNSW (maior = mais recall, menor = mais rápido)
+HNSW_EF_SEARCH = 64
+# Quantidade de listas invertidas visitadas por busca no índice IVFPQ
+IVF_NPROBE = 16
+
+# Cache semântico de consultas: queries quase idênticas (cosseno >= limiar)
+# reaproveitam o resultado formatado sem consultar o índice FAISS.
+CACHE_SIMILARIDADE_MINIMA = 0.92
+CACHE_TTL_SEGUNDOS = 24 * 60 * 60  # Entradas mais antigas são descartadas (evita resultados obsoletos)
+CACHE_MAX_ENTRADAS = 1000  # Ao ultrapassar, as entradas mais antigas são descartadas
+CACHE_VIZINHOS_CONSULTADOS = 8  # Entradas próximas examinadas (o mais similar pode ter outro k ou ter expirado)
+
 
 # =====================================================================
 # ETAPA 1: Funções Auxiliares de Carregamento e Busca
 # =====================================================================
 
+class ColunaMapeada:
+    """
+    Coluna de texto (Path ou Conteúdo) lida sob demanda de um arquivo binário
+    mapeado em memória (mmap). Indexar com um array de IDs decodifica apenas
+    as linhas selecionadas, sem carregar o corpus inteiro.
+    """
+
+    def __init__(self, dados: mmap.mmap, inicios: np.ndarray, fins: np.ndarray):
+        self.dados = dados
+        self.inicios = inicios
+        self.fins = fins
+
+    def __len__(self):
+        return len(self.inicios)
+
+    def __getitem__(self, ids: np.ndarray) -> np.ndarray:
+        # Um único gather vetorizado dos offsets (em vez de 2 acessos escalares ao memmap por ID)
+        inicios = self.inicios[ids].tolist()
+        fins = self.fins[ids].tolist()
+        return np.array(
+            [self.dados[inicio:fim].decode('utf-8') for inicio, fim in zip(inicios, fins)],
+            dtype=object
+        )
+
+
+def _carregar_colunas_mapeadas(nome_conteudo: str, nome_offsets: str):
+    # offsets[i] = (início do path, fim do path/início do conteúdo, fim do conteúdo)
+    offsets = np.load(nome_offsets, mmap_mode='r')
+    with open(nome_conteudo, 'rb') as f:
+        dados = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    paths = ColunaMapeada(dados, offsets[:, 0], offsets[:, 1])
+    conteudos = ColunaMapeada(dados, offsets[:, 1], offsets[:, 2])
+    return paths, conteudos
+
+
 def carregar_indice_e_metadados(nome_base_arquivo: str) -> Optional[Dict[str, Any]]:
     """
-    Carrega o índice FAISS e os metadados JSON salvos.
+    Carrega o índice FAISS e os metadados salvos.
+    Quando disponível, o conteúdo binário é mapeado em memória (mmap) e só as
+    linhas retornadas pela busca são lidas; caso contrário, usa o JSON.
     O nome_base_arquivo deve ser o termo curto, ex: 'ICMS_ST'.
     """
     # FAISS usa o nome base, e os metadados usam o nome base com sufixo
     nome_indice = f"faiss_index_{nome_base_arquivo}.faiss"
     nome_metadados = f"faiss_index_{nome_base_arquivo}_metadados.json"
+    nome_conteudo = f"faiss_index_{nome_base_arquivo}_conteudo.bin"
+    nome_offsets = f"faiss_index_{nome_base_arquivo}_offsets.npy"
     
     try:
         # 1. Carregar Índice FAISS
         index = faiss.read_index(nome_indice)
+        if isinstance(index, faiss.IndexHNSW):
+            index.hnsw.efSearch = HNSW_EF_SEARCH
+        elif isinstance(index, faiss.IndexIVF):
+            index.nprobe = IVF_NPROBE
         
-        # 2. Carregar Metadados
-        with open(nome_metadados, 'r', encoding='utf-8') as f:
-            metadados = json.load(f)
+        # 2. Carregar Metadados (acesso aleatório via mmap, sem parse O(N))
+        if os.path.exists(nome_conteudo) and os.path.exists(nome_offsets):
+            paths, conteudos = _carregar_colunas_mapeadas(nome_conteudo, nome_offsets)
+        else:
+            # Índices antigos (somente JSON): pré-computa arrays de Path/Conteúdo
+            with open(nome_metadados, 'rb') as f:
+                metadados = orjson.loads(f.read())
+            paths = np.array([m.get('path', 'N/A') for m in metadados], dtype=object)
+            conteudos = np.array([m['conteudo'] for m in metadados], dtype=object)
             
         print(f"✅ Índice FAISS e Metadados carregados com sucesso. Base: '{nome_base_arquivo}'.")
-        return {'index': index, 'metadados': metadados}
+        return {'index': index, 'paths': paths, 'conteudos': conteudos}
         
     except FileNotFoundError:
-        print(f"❌ Erro: Arquivos '{nome_indice}' ou '{nome_metadados}' não encontrados. Verifique se Legislacao.py foi executado com o termo '{nome_base_arquivo}'.")
+        print(f"❌ Erro: Arquivos '{nome_indice}' ou '{nome_conteudo}' não encontrados. Verifique se Legislacao.py foi executado com o termo '{nome_base_arquivo}'.")
         return None
     except Exception as e:
         print(f"❌ Erro ao carregar arquivos: {e}")
         return None
 
 
-def buscar_faiss(query: str, index, metadados: List[Dict[str, Any]], k: int = 5):
+def assinatura_indice(nome_indice: str) -> str:
     """
-    Vetoriza uma consulta (query), busca os K vizinhos mais próximos 
-    no índice FAISS e retorna os documentos mais relevantes.
+    Hash do conteúdo do arquivo .faiss. Uma reconstrução que gera o mesmo
+    índice (mesmo corpus) mantém a assinatura e, portanto, o cache semântico.
     """
-    # Aumentando K para 5, é um bom padrão para RAG
-    print(f"\n--- Buscando no FAISS (K={k}) para a query: '{query[:50]}...' ---")
+    hash_indice = hashlib.blake2b(digest_size=16)
+    with open(nome_indice, 'rb') as f:
+        for bloco in iter(lambda: f.read(1 << 20), b''):
+            hash_indice.update(bloco)
+    return hash_indice.hexdigest()
+
+
+def carregar_cache_semantico(nome_base_arquivo: str, assinatura: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Carrega o cache semântico de consultas associado ao índice (arquivo pickle).
+    O cache só é aproveitado se tiver sido gerado para o mesmo índice
+    (assinatura); as entradas expiradas (TTL) são descartadas e o IndexFlatIP
+    auxiliar é reconstruído a partir dos vetores persistidos.
+    """
+    nome_cache = f"faiss_index_{nome_base_arquivo}_cache.pkl"
+    cache = {'arquivo': nome_cache, 'assinatura': assinatura, 'alterado': False,
+             'index': None, 'vetores': [], 'resultados': [], 'timestamps': [], 'k': []}
+
+    try:
+        with open(nome_cache, 'rb') as f:
+            dados = pickle.load(f)
+    except FileNotFoundError:
+        return cache
+    except Exception as e:
+        print(f"⚠️ Cache semântico ignorado (arquivo inválido): {e}")
+        return cache
+
+    if dados.get('assinatura') != assinatura:
+        # Gerado para outro índice (o corpus mudou): os resultados não valem mais
+        return cache
+
+    agora = time.time()
+    for vetor, resultado, timestamp, k in zip(dados['vetores'], dados['resultados'], dados['timestamps'], dados['k']):
+        if agora - timestamp < CACHE_TTL_SEGUNDOS:
+            _adicionar_ao_cache(cache, vetor.reshape(1, -1), resultado, k, timestamp)
+    cache['alterado'] = False
+
+    return cache
+
+
+def salvar_cache_semantico(cache: Dict[str, Any]):
+    """
+    Persiste o cache semântico de consultas em disco (arquivo pickle), apenas
+    se houver entradas novas desde o carregamento/último salvamento.
+    """
+    if not cache['alterado']:
+        return
+    try:
+        with open(f"{cache['arquivo']}.tmp", 'wb') as f:
+            pickle.dump({
+                'assinatura': cache['assinatura'],
+                'vetores': cache['vetores'],
+                'resultados': cache['resultados'],
+                'timestamps': cache['timestamps'],
+                'k': cache['k'],
+            }, f)
+        os.replace(f"{cache['arquivo']}.tmp", cache['arquivo'])
+        cache['alterado'] = False
+    except Exception as e:
+        print(f"⚠️ Não foi possível salvar o cache semântico: {e}")
+
+
+def _adicionar_ao_cache(cache: Dict[str, Any], query_embedding: np.ndarray, resultado: str, k: int, timestamp: float):
+    # O IndexFlatIP é criado sob demanda, pois a dimensão só é conhecida no primeiro vetor
+    if cache['index'] is None:
+        cache['index'] = faiss.IndexFlatIP(query_embedding.shape[1])
+    cache['index'].add(query_embedding)
+    cache['vetores'].append(query_embedding[0])
+    cache['resultados'].append(resultado)
+    cache['timestamps'].append(timestamp)
+    cache['k'].append(k)
+    cache['alterado'] = True
+
+    if len(cache['vetores']) > CACHE_MAX_ENTRADAS:
+        # Mantém as 3/4 mais recentes (listas em ordem de inserção) e reconstrói
+        # o índice auxiliar: a poda não acontece a cada nova entrada
+        manter = slice(-(CACHE_MAX_ENTRADAS * 3 // 4), None)
+        for chave in ('vetores', 'resultados', 'timestamps', 'k'):
+            cache[chave] = cache[chave][manter]
+        cache['index'].reset()
+        cache['index'].add(np.stack(cache['vetores']))
+
+
+def _buscar_no_cache(cache: Dict[str, Any], query_embedding: np.ndarray, k: int) -> Optional[str]:
+    # Vetores normalizados: produto interno ≡ similaridade de cosseno
+    if cache['index'] is None or cache['index'].ntotal == 0:
+        return None
+
+    # Vizinhos em ordem decrescente de similaridade: usa o primeiro acima do
+    # limiar com o mesmo k e ainda dentro do TTL
+    similaridades, posicoes = cache['index'].search(query_embedding, CACHE_VIZINHOS_CONSULTADOS)
+    agora = time.time()
+    for similaridade, posicao in zip(similaridades[0], posicoes[0]):
+        if posicao == -1 or similaridade < CACHE_SIMILARIDADE_MINIMA:
+            break
+        if cache['k'][posicao] == k and agora - cache['timestamps'][posicao] < CACHE_TTL_SEGUNDOS:
+            return cache['resultados'][posicao]
+
+    return None
+
+
+def _formatar_resultados(distancias: np.ndarray, indices: np.ndarray, paths, conteudos) -> str:
+    """
+    Mapeia os IDs retornados pelo FAISS (uma linha de resultados) de volta
+    para Path/Conteúdo e formata a saída como uma string única.
+    Os metadados não são alterados (sem 'rank'/'distancia' gravados nos dicts).
+    """
+    # Descarta posições vazias (-1); o FAISS já retorna os vizinhos ordenados
+    validos = indices != -1
+    ids = indices[validos]
+    distancias = distancias[validos]
+        
+    print(f"✅ Busca concluída. {len(ids)} documentos encontrados.")
     
-    # 1. Gerar o embedding da query (vetor de busca)
-    query_embedding = MODELO_EMBEDDING.encode(
-        [query], 
-        convert_to_numpy=True
-    ).astype('float32')
+    # Formata a saída como uma string única para ser lida pelo script chamador
+    partes = [
+        f"--- DOCUMENTO RANK {rank} ---\n"
+        f"URL/Fonte: {path}\n"
+        f"Distância (Similaridade): {distancia:.4f}\n"
+        f"Conteúdo:\n{conteudo}\n\n"
+        for rank, (path, distancia, conteudo) in enumerate(zip(paths[ids], distancias, conteudos[ids]), 1)
+    ]
+    return ''.join(partes)
+
+
+def buscar_faiss(queries: Union[str, List[str]], index, paths, conteudos, k: int = 5, cache: Optional[Dict[str, Any]] = None, modelo=None):
+    """
+    Vetoriza as consultas (queries) em um único batch, busca os K vizinhos mais
+    próximos de todas elas com uma única chamada ao índice FAISS e retorna os
+    documentos mais relevantes de cada uma (lista de strings formatadas).
+    Para compatibilidade, uma query única (str) retorna uma única string.
+    Se um cache semântico for informado, consultas quase idênticas a uma
+    anterior retornam o resultado em cache sem acessar o índice.
+    """
+    query_unica = isinstance(queries, str)
+    if query_unica:
+        queries = [queries]
+
+    # Aumentando K para 5, é um bom padrão para RAG
+    for query in queries:
+        print(f"\n--- Buscando no FAISS (K={k}) para a query: '{query[:50]}...' ---")
     
-    # 2. Busca no índice (D: Distâncias, I: Índices/IDs dos vetores)
-    distancias, indices = index.search(query_embedding, k)
+    # 1. Gerar os embeddings das queries em batch (vetores de busca)
+    # Já normalizados em L2, como os vetores do índice (produto interno ≡ cosseno)
+    query_embeddings = gerar_embeddings(queries, modelo=modelo, batch_size=64, normalize_embeddings=True)
     
-    resultados_relevantes = []
+    # 1.1. Consulta o cache semântico antes do índice
+    resultados: List[Optional[str]] = [None] * len(queries)
+    if cache is not None:
+        for posicao in range(len(queries)):
+            resultados[posicao] = _buscar_no_cache(cache, query_embeddings[posicao:posicao + 1], k)
+            if resultados[posicao] is not None:
+                print("✅ Busca concluída (cache semântico).")
     
-    # 3. Mapear IDs de volta para os Metadados
-    for i in range(k):
-        id_sequencial = indices[0][i]
-        
-        if id_sequencial == -1:
-            continue
-
-        distancia = distancias[0][i]
-        documento_relevante = metadados[id_sequencial]
-        
-        documento_relevante['rank'] = i + 1
-        documento_relevante['distancia_l2'] = float(distancia) 
+    pendentes = [posicao for posicao, resultado in enumerate(resultados) if resultado is None]
+    if pendentes:
+        # 2. Busca no índice de todas as queries pendentes de uma só vez
+        # (D: Distâncias, I: Índices/IDs dos vetores, ambos com formato (Q, k))
+        embeddings_pendentes = np.ascontiguousarray(query_embeddings[pendentes])
+        distancias, indices = index.search(embeddings_pendentes, k)
+        if index.metric_type == faiss.METRIC_INNER_PRODUCT:
+            # Mantém a semântica de "distância" da saída (menor = mais similar)
+            distancias = 1.0 - distancias
         
-        resultados_relevantes.append(documento_relevante)
+        # 3. Mapear IDs de volta para os Metadados e formatar cada resultado
+        for linha, posicao in enumerate(pendentes):
+            resultados[posicao] = _formatar_resultados(distancias[linha], indices[linha], paths, conteudos)
+            if cache is not None:
+                _adicionar_ao_cache(cache, embeddings_pendentes[linha:linha + 1], resultados[posicao], k, time.time())
         
-    print(f"✅ Busca concluída. {len(resultados_relevantes)} documentos encontrados.")
-    
-    # Formata a saída como uma string única para ser lida pelo script chamador
-    saida_formatada = ""
-    for res in resultados_relevantes:
-        saida_formatada += f"--- DOCUMENTO RANK {res['rank']} ---\n"
-        saida_formatada += f"URL/Fonte: {res.get('path', 'N/A')}\n"
-        saida_formatada += f"Distância (Similaridade): {res['distancia_l2']:.4f}\n"
-        saida_formatada += f"Conteúdo:\n{res['conteudo']}\n\n"
-        
-    return saida_formatada
+    return resultados[0] if query_unica else resultados
+
+
+# Índices já carregados neste processo: termo -> (mtime do .faiss, dados, cache semântico).
+# Evita reler o índice a cada consulta quando o processo é reutilizado (LLM.py, --serve).
+_INDICES_CARREGADOS: Dict[str, Any] = {}
+
+
+def _obter_indice(termo: str):
+    nome_indice = f"faiss_index_{termo}.faiss"
+    try:
+        mtime = os.path.getmtime(nome_indice)
+    except OSError:
+        mtime = None
+
+    # Reutiliza o índice em memória enquanto o arquivo não for reconstruído
+    carregado = _INDICES_CARREGADOS.get(termo)
+    if carregado is not None and carregado[0] == mtime:
+        return carregado[1], carregado[2]
+
+    dados_carregados = carregar_indice_e_metadados(termo)
+    if not dados_carregados:
+        return None, None
+
+    cache_semantico = carregar_cache_semantico(termo, assinatura_indice(nome_indice))
+    _INDICES_CARREGADOS[termo] = (mtime, dados_carregados, cache_semantico)
+    return dados_carregados, cache_semantico
+
+
+def buscar(termo: str, query: Union[str, List[str]], k: int = 5, modelo=None):
+    """
+    Carrega o índice do termo e executa a busca semântica (com cache).
+    Pode ser chamada diretamente (sem subprocess) reutilizando um modelo já
+    carregado. O índice fica em memória para as chamadas seguintes.
+    Retorna None se o índice não puder ser carregado.
+    """
+    # 1. Carregar Índice (ou reutilizar o já carregado)
+    dados_carregados, cache_semantico = _obter_indice(termo)
+    if not dados_carregados:
+        return None
+
+    # 2. Executar a Busca Semântica
+    resultados = buscar_faiss(
+        queries=query,
+        index=dados_carregados['index'],
+        paths=dados_carregados['paths'],
+        conteudos=dados_carregados['conteudos'],
+        k=k, # Quantidade de documentos mais relevantes para retornar
+        cache=cache_semantico,
+        modelo=modelo
+    )
+    salvar_cache_semantico(cache_semantico)
+    return resultados
+
+
+def servir():
+    """
+    Modo worker persistente (--serve): carrega o modelo uma única vez e atende
+    consultas em JSON, uma por linha, via stdin/stdout:
+        entrada: {"termo": "ICMS_ST", "query": "Legislação sobre ...", "k": 5}
+        saída:   {"resultado": "<string formatada>" | null}
+    As mensagens de progresso vão para o stderr para não corromper o protocolo.
+    """
+    saida = _SAIDA_PROTOCOLO.buffer
+    for linha in sys.stdin:
+        if not linha.strip():
+            continue
+        try:
+            pedido = orjson.loads(linha)
+            with contextlib.redirect_stdout(sys.stderr):
+                resultado = buscar(pedido['termo'], pedido['query'], k=pedido.get('k', 5))
+            resposta = {'resultado': resultado}
+        except Exception as e:
+            resposta = {'resultado': None, 'erro': str(e)}
+        saida.write(orjson.dumps(resposta) + b"\n")
+        saida.flush()
 
 
 # =====================================================================
@@ -111,9 +387,15 @@ def buscar_faiss(query: str, index, metadados: List[Dict[str, Any]], k: int = 5)
 
 if __name__ == "__main__":
     
+    # Modo worker: um processo de longa duração atende várias consultas
+    if sys.argv[1:] == ["--serve"]:
+        servir()
+        sys.exit(0)
+
     # Verifica se os argumentos necessários foram fornecidos
     if len(sys.argv) < 3:
         print("Uso: python BuscaFaiss.py <termo_curto_do_faiss> <query_de_busca_completa>")
+        print("     python BuscaFaiss.py --serve   (worker persistente, JSON por linha no stdin/stdout)")
         print("Exemplo: python BuscaFaiss.py 'ICMS_ST' 'Legislação sobre ICMS-ST de produtos alimentícios'")
         sys.exit(1)
 
@@ -121,23 +403,10 @@ if __name__ == "__main__":
     TERMO_CURTO_FAISS = sys.argv[1] # Ex: 'ICMS_ST' - O termo usado para criar o índice
     QUERY_DE_BUSCA = sys.argv[2] # Ex: 'Legislação sobre ICMS-ST de produtos alimentícios'
 
-    # 1. Carregar Índice
-    dados_carregados = carregar_indice_e_metadados(TERMO_CURTO_FAISS)
+    resultados_string = buscar(TERMO_CURTO_FAISS, QUERY_DE_BUSCA, k=5)
     
-    if dados_carregados:
-        index_faiss = dados_carregados['index']
-        metadados_docs = dados_carregados['metadados']
-
-        # 2. Executar a Busca Semântica
-        resultados_string = buscar_faiss(
-            query=QUERY_DE_BUSCA,
-            index=index_faiss,
-            metadados=metadados_docs,
-            k=5 # Quantidade de documentos mais relevantes para retornar
-        )
-        
-        # 3. Imprimir a String de Resultados para que o script chamador (ProcessaNFe.py) capture
-        # NOTA: O script chamador irá capturar TUDO o que for impresso no stdout (print)
+    if resultados_string is not None:
+        # Imprimir a String de Resultados para uso via linha de comando
         print(resultados_string) 
 
     else:
@@ -0,0 +1,19 @@
+import os
+
+# =====================================================================
+# Configuração de Threads (OpenMP/MKL)
+# Deve ser importado ANTES de numpy/torch/faiss: as variáveis de ambiente
+# só têm efeito se definidas antes do carregamento dessas bibliotecas.
+# =====================================================================
+
+# Metade dos núcleos para o FAISS (OpenMP), deixando o restante para o PyTorch:
+# no pipeline de Legislacao.py a geração de embeddings e a construção do índice
+# rodam ao mesmo tempo, e as duas juntas não devem passar do total de núcleos.
+NUM_THREADS_FAISS = max(1, (os.cpu_count() or 1) // 2)
+NUM_THREADS_TORCH = max(1, (os.cpu_count() or 1) - NUM_THREADS_FAISS)
+
+# setdefault: valores definidos explicitamente pelo usuário têm precedência
+os.environ.setdefault("OMP_NUM_THREADS", str(NUM_THREADS_FAISS))
+os.environ.setdefault("MKL_NUM_THREADS", str(NUM_THREADS_FAISS))
+# Fixa as threads do OpenMP da Intel em núcleos próximos (evita migração entre núcleos)
+os.environ.setdefault("KMP_AFFINITY", "granularity=fine,compact,1,0")
@@ -1,22 +1,39 @@
 import sys
 import os
-import subprocess
+import ConfiguracaoThreads # Antes de numpy/torch/faiss (variáveis OMP/MKL)
 import json
 import time # Importar a biblioteca 'time'
+import shelve
+import hashlib
 from google import genai
 from google.genai import types
+from lxml import etree # Para condensar o XML antes de enviá-lo ao Gemini
 
 # Bibliotecas Adicionais para Geração de PDF
 import mistune # Para converter Markdown para HTML
 from weasyprint import HTML, CSS # Para converter HTML para PDF
 
+# Etapas de RAG executadas no próprio processo (um único carregamento do MiniLM)
+from ModeloEmbedding import MODELO_EMBEDDING
+from Legislacao import construir_indice, configurar_log
+from BuscaFaiss import buscar
+
 # ----------------------------------------------------------------------
 # 1. Funções de Suporte
 # ----------------------------------------------------------------------
 
+# Elementos da NF-e sem valor semântico para a análise (assinatura digital,
+# QR Code, hashes), removidos antes de enviar o XML ao Gemini.
+ELEMENTOS_XML_IGNORADOS = {'Signature', 'infNFeSupl', 'qrCode', 'urlChave', 'digVal'}
+# Limite de caracteres do XML condensado enviado nos prompts
+MAX_CARACTERES_XML = 32000
+# Cache em disco dos termos extraídos pelo Gemini, indexado pelo hash do XML condensado
+ARQUIVO_CACHE_TERMOS = "gemini_terms_cache.db"
+
 def ler_conteudo_xml_bruto(caminho_arquivo):
     """
-    Lê o conteúdo de um arquivo XML e o retorna como string bruta.
+    Lê o conteúdo de um arquivo XML e o retorna como bytes brutos.
+    A decodificação para texto só é feita quando o conteúdo é enviado ao Gemini.
     """
     print("--- INÍCIO DA ETAPA: Leitura do XML Bruto ---")
     if not os.path.exists(caminho_arquivo):
@@ -24,10 +41,10 @@ def ler_conteudo_xml_bruto(caminho_arquivo):
         return None
         
     try:
-        with open(caminho_arquivo, 'r', encoding='utf-8') as f:
+        with open(caminho_arquivo, 'rb') as f:
             conteudo_xml = f.read()
         
-        print(f"SUCESSO: XML lido. Tamanho do conteúdo: {len(conteudo_xml)} caracteres.")
+        print(f"SUCESSO: XML lido. Tamanho do conteúdo: {os.path.getsize(caminho_arquivo)} bytes.")
         print("--- FIM DA ETAPA: Leitura do XML Bruto ---\n")
         return conteudo_xml
         
@@ -36,10 +53,62 @@ def ler_conteudo_xml_bruto(caminho_arquivo):
         print("--- FIM DA ETAPA: Leitura do XML Bruto (FALHA) ---\n")
         return None
 
-def extrair_termos_gemini(conteudo_xml_bruto):
+def condensar_xml(conteudo_xml_bruto):
+    """
+    Reduz o XML bruto (bytes) ao que tem valor semântico para o Gemini:
+    remove espaços, comentários, namespaces e os elementos de ELEMENTOS_XML_IGNORADOS,
+    limitando o resultado a MAX_CARACTERES_XML caracteres.
+    """
+    try:
+        parser = etree.XMLParser(remove_blank_text=True, remove_comments=True)
+        raiz = etree.fromstring(conteudo_xml_bruto, parser=parser)
+
+        for elemento in list(raiz.iter()):
+            if not isinstance(elemento.tag, str):
+                continue
+            nome_local = etree.QName(elemento).localname
+            if nome_local in ELEMENTOS_XML_IGNORADOS and elemento.getparent() is not None:
+                elemento.getparent().remove(elemento)
+            else:
+                # Remove o namespace repetido em todas as tags
+                elemento.tag = nome_local
+        etree.cleanup_namespaces(raiz)
+
+        xml_condensado = etree.tostring(raiz, encoding='unicode')
+    except etree.XMLSyntaxError as e:
+        print(f"AVISO: XML não pôde ser condensado ({e}). Usando o conteúdo bruto.")
+        xml_condensado = conteudo_xml_bruto.decode('utf-8', errors='replace')
+
+    return xml_condensado[:MAX_CARACTERES_XML]
+
+def buscar_termos_em_cache(conteudo_xml):
+    """
+    Retorna a tupla (termo_curto, termo_completo) já extraída para este XML
+    condensado, ou (None, None) se ele ainda não foi processado.
+    """
+    chave = hashlib.sha256(conteudo_xml.encode('utf-8')).hexdigest()
+    try:
+        with shelve.open(ARQUIVO_CACHE_TERMOS) as cache:
+            return cache.get(chave, (None, None))
+    except Exception as e:
+        print(f"AVISO: Cache de termos indisponível: {e}")
+        return None, None
+
+def salvar_termos_em_cache(conteudo_xml, termo_curto, termo_completo):
+    """
+    Armazena os termos extraídos pelo Gemini para este XML condensado.
+    """
+    chave = hashlib.sha256(conteudo_xml.encode('utf-8')).hexdigest()
+    try:
+        with shelve.open(ARQUIVO_CACHE_TERMOS) as cache:
+            cache[chave] = (termo_curto, termo_completo)
+    except Exception as e:
+        print(f"AVISO: Não foi possível salvar o cache de termos: {e}")
+
+def extrair_termos_gemini(conteudo_xml):
     """
     ETAPA 1: Análise Semântica e Extração de Termos-Chave (Gemini)
-    Envia o conteúdo XML bruto ao Gemini para extrair palavras-chave e frases curtas.
+    Envia o conteúdo XML (condensado) ao Gemini para extrair palavras-chave e frases curtas.
     Retorna uma tupla (termo_curto, termo_completo).
     """
     print("--- INÍCIO DA ETAPA 1: Análise Semântica (Gemini) ---")
@@ -60,9 +129,9 @@ def extrair_termos_gemini(conteudo_xml_bruto):
           "termo_completo": "frase curta e descritiva"
         }}
         
-        Conteúdo do XML (Bruto):
+        Conteúdo do XML (Condensado):
         ---
-        {conteudo_xml_bruto}... [Conteúdo Omitido]
+        {conteudo_xml}... [Conteúdo Omitido]
         ---
         """
         
@@ -95,75 +164,56 @@ def extrair_termos_gemini(conteudo_xml_bruto):
         print("--- FIM DA ETAPA 1: Análise Semântica (FALHA) ---\n")
         return None, None
 
-def executar_script_simples(script, argumento):
+def executar_geracao_corpus(termo):
     """
     ETAPA 2: Geração Dinâmica do Corpus Jurídico (Legislacao.py)
-    Executa um script Python via subprocess.
+    Constrói o índice FAISS no próprio processo, reutilizando o modelo de embedding compartilhado.
     """
     print(f"--- INÍCIO DA ETAPA 2: Geração Dinâmica do Corpus Jurídico ---")
-    comando = [sys.executable, script, argumento]
-    print(f"-> Executando {script} para construir/filtrar o índice FAISS com argumento: {argumento}")
+    print(f"-> Construindo/filtrando o índice FAISS com argumento: {termo}")
     try:
-        resultado = subprocess.run(
-            comando, 
-            capture_output=True, 
-            text=True, 
-            check=True
-        )
-        
-        # Assume-se que o script de legislação cria o índice
-        print(f"SUCESSO: Índice FAISS supostamente pronto para o termo.")
-        print(f"   Saída de {script} (Parcial):\n{resultado.stdout.strip()[:200]}...")
+        if not construir_indice(termo, modelo=MODELO_EMBEDDING):
+            print(f"ERRO: Não foi possível construir o índice FAISS para o termo '{termo}'.")
+            print("--- FIM DA ETAPA 2: Geração Dinâmica do Corpus Jurídico (FALHA) ---\n")
+            return False
+
+        print(f"SUCESSO: Índice FAISS pronto para o termo.")
         print("--- FIM DA ETAPA 2: Geração Dinâmica do Corpus Jurídico ---\n")
-        return resultado.stdout
-    except subprocess.CalledProcessError as e:
-        print(f"ERRO ao executar {script} (Código de saída: {e.returncode}).")
-        print(f"   STDERR:\n{e.stderr.strip()}")
-        print("--- FIM DA ETAPA 2: Geração Dinâmica do Corpus Jurídico (FALHA) ---\n")
-        return None
-    except FileNotFoundError:
-        print(f"ERRO: O script {script} não foi encontrado.")
+        return True
+    except Exception as e:
+        print(f"ERRO ao construir o índice FAISS: {e}")
         print("--- FIM DA ETAPA 2: Geração Dinâmica do Corpus Jurídico (FALHA) ---\n")
-        return None
+        return False
 
-def executar_busca_faiss(script, termo_faiss, query_completa):
+def executar_busca_faiss(termo_faiss, query_completa):
     """
     ETAPA 3: Busca de Similaridade Vetorial (FAISS)
-    Executa o BuscaFaiss.py com os dois argumentos.
+    Busca no índice no próprio processo, reutilizando o modelo de embedding compartilhado.
     """
     print(f"--- INÍCIO DA ETAPA 3: Busca de Similaridade Vetorial (FAISS) ---")
-    comando = [sys.executable, script, termo_faiss, query_completa]
-    print(f"-> Executando {script} no índice para buscar: '{query_completa}'")
+    print(f"-> Buscando no índice: '{query_completa}'")
     try:
-        resultado = subprocess.run(
-            comando, 
-            capture_output=True, 
-            text=True, 
-            check=True
-        )
-        
-        resultados_busca = resultado.stdout
-        if "Nenhum resultado relevante encontrado" in resultados_busca:
+        resultados_busca = buscar(termo_faiss, query_completa, k=5, modelo=MODELO_EMBEDDING)
+        if resultados_busca is None:
+            print("--- FIM DA ETAPA 3: Busca de Similaridade Vetorial (FAISS) (FALHA) ---\n")
+            return None
+
+        if not resultados_busca:
              print("AVISO: A busca FAISS retornou resultados limitados ou irrelevantes.")
 
         print(f"SUCESSO: Trechos de lei encontrados e extraídos.")
-        print(f"   Saída de {script} (Parcial):\n{resultados_busca.strip()[:200]}...")
+        print(f"   Resultado da busca (Parcial):\n{resultados_busca.strip()[:200]}...")
         print("--- FIM DA ETAPA 3: Busca de Similaridade Vetorial (FAISS) ---\n")
         return resultados_busca
-    except subprocess.CalledProcessError as e:
-        print(f"ERRO ao executar {script} (Código de saída: {e.returncode}).")
-        print(f"   STDERR:\n{e.stderr.strip()}")
-        print("--- FIM DA ETAPA 3: Busca de Similaridade Vetorial (FAISS) (FALHA) ---\n")
-        return f"ERRO NA BUSCA FAISS:\n{e.stderr}" 
-    except FileNotFoundError:
-        print(f"ERRO: O script {script} não foi encontrado.")
+    except Exception as e:
+        print(f"ERRO na busca FAISS: {e}")
         print("--- FIM DA ETAPA 3: Busca de Similaridade Vetorial (FAISS) (FALHA) ---\n")
-        return None
+        return f"ERRO NA BUSCA FAISS:\n{e}"
 
-def analisar_resultados_gemini(conteudo_xml_bruto, resultados_busca):
+def analisar_resultados_gemini(conteudo_xml, resultados_busca):
     """
     ETAPA 4: Análise e Geração de Insights de Valor (Gemini)
-    Envia o XML bruto e os resultados da busca ao Gemini para análise final.
+    Envia o XML (condensado) e os resultados da busca ao Gemini para análise final.
     """
     print("--- INÍCIO DA ETAPA 4: Análise e Geração de Insights (Gemini) ---")
     print("-> Enviando XML e resultados da busca para a análise final do Gemini...")
@@ -171,7 +221,7 @@ def analisar_resultados_gemini(conteudo_xml_bruto, resultados_busca):
         client = genai.Client()
 
         prompt = f"""
-        Abaixo estão o conteúdo BRUTO de uma Nota Fiscal Eletrônica (XML) e um trecho de leis relevantes encontrado (FAISS).
+        Abaixo estão o conteúdo CONDENSADO de uma Nota Fiscal Eletrônica (XML, sem namespaces, comentários, assinatura digital e demais blocos sem valor semântico, possivelmente truncado) e um trecho de leis relevantes encontrado (FAISS).
         
         Sua tarefa é gerar uma análise detalhada ESTRITAMENTE no formato MARKDOWN, usando títulos (#), subtítulos (##) e listas.
         
@@ -181,6 +231,16 @@ def analisar_resultados_gemini(conteudo_xml_bruto, resultados_busca):
         4. **Oportunidade de Economia/Benefício:** O mais importante: Cite dicas para aplicação de lei para reduzir recolhimento ou obter algum benefício legal e mensurar o quanto economiza com esta ação. Mostrar se possível em R$.
         
         Gere a análise SOMENTE em formato Markdown, começando com um título de nível 1.
+        
+        Conteúdo do XML (Condensado):
+        ---
+        {conteudo_xml}
+        ---
+        
+        Trechos de Leis Relevantes (FAISS):
+        ---
+        {resultados_busca}
+        ---
         """
 
         response = client.models.generate_content(
@@ -259,6 +319,7 @@ def gerar_pdf(conteudo_markdown, nome_arquivo_xml):
 # ----------------------------------------------------------------------
 
 def main():
+    configurar_log() # Log das etapas de Legislacao.construir_indice no stdout
     print("\n=======================================================")
     print("         INÍCIO DO PROCESSAMENTO DE NOTA FISCAL")
     print("=======================================================")
@@ -276,33 +337,43 @@ def main():
         print("Fluxo interrompido após falha na leitura do XML.")
         sys.exit(1)
 
-    # --- 2. ETAPA 1: Extrair Termos com Gemini ---
-    termo_curto, termo_completo = extrair_termos_gemini(conteudo_xml_bruto)
-    if not termo_curto or not termo_completo:
-        print("Fluxo interrompido após falha na extração de termos.")
-        sys.exit(1)
+    # Condensa o XML uma única vez; o mesmo texto é usado nos dois prompts do Gemini
+    conteudo_xml = condensar_xml(conteudo_xml_bruto)
+    print(f"XML condensado para {len(conteudo_xml)} caracteres.\n")
+
+    # --- 2. ETAPA 1: Extrair Termos (cache local ou Gemini) ---
+    termo_curto, termo_completo = buscar_termos_em_cache(conteudo_xml)
+    if termo_curto and termo_completo:
+        print("--- ETAPA 1: Termos reaproveitados do cache (sem chamada ao Gemini) ---")
+        print(f"   [Termo Curto (FAISS Index)]: {termo_curto}")
+        print(f"   [Termo Completo (FAISS Query)]: {termo_completo}\n")
+    else:
+        termo_curto, termo_completo = extrair_termos_gemini(conteudo_xml)
+        if not termo_curto or not termo_completo:
+            print("Fluxo interrompido após falha na extração de termos.")
+            sys.exit(1)
+        salvar_termos_em_cache(conteudo_xml, termo_curto, termo_completo)
 
-    # --- DELAY para Rate Limit ---
-    DELAY_SEGUNDOS = 3
-    print(f"--- GESTÃO DE RATE LIMIT: Aguardando {DELAY_SEGUNDOS} segundos antes da próxima chamada à API (Gemini)... ---")
-    time.sleep(DELAY_SEGUNDOS)
-    print("--- DELAY CONCLUÍDO. ---\n")
+        # --- DELAY para Rate Limit (apenas quando a API foi chamada) ---
+        DELAY_SEGUNDOS = 3
+        print(f"--- GESTÃO DE RATE LIMIT: Aguardando {DELAY_SEGUNDOS} segundos antes da próxima chamada à API (Gemini)... ---")
+        time.sleep(DELAY_SEGUNDOS)
+        print("--- DELAY CONCLUÍDO. ---\n")
     
-    # --- 3. ETAPA 2: Rodar Legislacao.py para gerar o índice FAISS ---
-    legislacao_output = executar_script_simples("Legislacao.py", termo_curto)
-    if legislacao_output is None:
+    # --- 3. ETAPA 2: Gerar o índice FAISS (Legislacao.py) ---
+    if not executar_geracao_corpus(termo_curto):
         print("Fluxo interrompido após falha na Geração do Corpus Jurídico.")
         sys.exit(1)
         
-    # --- 4. ETAPA 3: Rodar BuscaFaiss.py para buscar no índice ---
-    resultados_busca = executar_busca_faiss("BuscaFaiss.py", termo_curto, termo_completo)
+    # --- 4. ETAPA 3: Buscar no índice (BuscaFaiss.py) ---
+    resultados_busca = executar_busca_faiss(termo_curto, termo_completo)
     
     if resultados_busca is None or "ERRO NA BUSCA FAISS" in resultados_busca:
         print("Fluxo interrompido após falha na Busca de Similaridade Vetorial.")
         sys.exit(1)
 
     # --- 5. ETAPA 4: Análise Final do Gemini (Gera MARKDOWN) ---
-    analise_final_markdown = analisar_resultados_gemini(conteudo_xml_bruto, resultados_busca)
+    analise_final_markdown = analisar_resultados_gemini(conteudo_xml, resultados_busca)
     
     # --- 6. ETAPA 5: Geração do PDF ---
     if analise_final_markdown and not "Erro de Análise" in analise_final_markdown:
@@ -1,64 +1,177 @@
+import os
+import atexit
+import logging
+import logging.handlers
+import queue
+import socket
+import threading
+from urllib.parse import urlsplit
+import asyncio
+import time
+import tempfile
+import contextlib
+from ConfiguracaoThreads import NUM_THREADS_FAISS # Antes de numpy/faiss/torch
+import hashlib
+import json
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib3.exceptions import HTTPError as ErroLeituraUrllib3
 import sys
-import json
+import re
 import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from xml.sax.saxutils import escape as xml_escape
 import numpy as np
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, NamedTuple, Tuple, Iterable, Iterator, Union
 
 # =====================================================================
 # ETAPA 0: Importação e Configuração FAISS (NOVA)
 # =====================================================================
 try:
-    from sentence_transformers import SentenceTransformer
     import faiss
+    faiss.omp_set_num_threads(NUM_THREADS_FAISS) # Evita disputa de threads com o PyTorch
+    import orjson # Parser/serializador JSON rápido (2-5x mais rápido que o json da stdlib)
     
-    # 🌟 MODELO BERT LEVE 🌟
-    MODELO_EMBEDDING = SentenceTransformer('all-MiniLM-L6-v2') 
+    # 🌟 MODELO BERT LEVE 🌟 (compartilhado com BuscaFaiss.py)
+    from ModeloEmbedding import gerar_embeddings_corpus, NOME_MODELO_EMBEDDING, PRECISAO
     
     print("✅ Modelo de Embedding BERT Leve (all-MiniLM-L6-v2) e FAISS carregados.")
 except ImportError:
-    print("❌ ERRO: As bibliotecas 'torch', 'sentence-transformers', 'numpy' ou 'faiss-cpu' não estão instaladas.")
-    print("       Execute: pip install torch sentence-transformers numpy faiss-cpu")
+    print("❌ ERRO: As bibliotecas 'torch', 'sentence-transformers', 'numpy', 'faiss-cpu' ou 'orjson' não estão instaladas.")
+    print("       Execute: pip install torch sentence-transformers numpy faiss-cpu orjson")
     sys.exit(1)
 
+# aiohttp (opcional): requisições concorrentes para vários termos
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+# Brotli (opcional): com ele, urllib3 e aiohttp descomprimem respostas 'br'
+try:
+    import brotli
+except ImportError:
+    try:
+        import brotlicffi as brotli
+    except ImportError:
+        brotli = None
+
+# ijson (opcional): extrai as linhas de resultado enquanto a resposta é lida,
+# sem materializar o JSON inteiro em memória
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+logger = logging.getLogger(__name__)
+
+
+def configurar_log():
+    """
+    Log assíncrono para os pontos de entrada (este script e LLM.main): as
+    chamadas de log apenas enfileiram o registro e a escrita no stdout acontece
+    em uma thread própria (QueueListener), sem bloquear o event loop do aiohttp
+    nem serializar as threads do pipeline no lock do stdout. Quem apenas importa
+    o módulo mantém a configuração de logging da aplicação.
+    """
+    if logger.handlers:
+        return
+    fila_log: queue.Queue = queue.Queue(-1)
+    saida_log = logging.StreamHandler(sys.stdout)
+    saida_log.setFormatter(logging.Formatter("%(message)s"))
+    ouvinte_log = logging.handlers.QueueListener(fila_log, saida_log)
+    ouvinte_log.start()
+    atexit.register(ouvinte_log.stop) # Esvazia a fila antes de encerrar o processo
+    logger.addHandler(logging.handlers.QueueHandler(fila_log))
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+
+# Corpora pequenos usam busca exata por produto interno (IndexFlatIP): abaixo
+# deste tamanho a varredura completa é mais barata que percorrer um grafo HNSW.
+HNSW_MIN_VETORES = 1000
+
+# Parâmetros do índice HNSW (grafo de vizinhança para busca aproximada)
+HNSW_M = 32                 # Número de vizinhos por nó do grafo
+HNSW_EF_CONSTRUCTION = 200  # Amplitude da busca durante a construção do grafo
+
+# Parâmetros do índice IVFPQ (listas invertidas + quantização de produto)
+# Usado apenas para corpora grandes: o treino do PQ (nbits=8 -> 256 centróides
+# por subespaço) e das listas invertidas exige um número mínimo de vetores.
+IVFPQ_MIN_VETORES = 10000   # Abaixo disso o HNSW é mais preciso e igualmente rápido
+IVFPQ_M = 48                # Subquantizadores (384 / 48 = 8 dimensões cada, 48 bytes/vetor)
+IVFPQ_NBITS = 8             # Bits por código do subquantizador
+
+# Cache em disco dos embeddings, indexado pelo hash do conteúdo de cada documento:
+# documentos inalterados não passam novamente pelo modelo a cada reconstrução.
+ARQUIVO_CACHE_EMBEDDINGS = "embeddings_cache.npz"
+# Vetores de backends/precisões diferentes (FP32, FP16, BF16, ONNX INT8) não se misturam
+ASSINATURA_CACHE_EMBEDDINGS = f"{NOME_MODELO_EMBEDDING}:{PRECISAO}"
+# Limite de entradas do cache: mantém os documentos usados mais recentemente
+MAX_CACHE_EMBEDDINGS = 20000
+
 
 # =====================================================================
 # ETAPA 1: Funções de Geração e Processamento (Com BERT Leve/MiniLM)
 # (Mantidas as funções de processamento de dados)
 # =====================================================================
 
-def desserializar_json_resistente(texto_json: str) -> Optional[List[Dict[str, Any]]]:
+def desserializar_json_resistente(texto_json: Union[str, bytes]) -> Optional[List[Dict[str, Any]]]:
     """
-    Tenta desserializar uma string JSON. Inclui tratamento de erro (resistência).
+    Tenta desserializar um JSON (str ou bytes). Inclui tratamento de erro (resistência).
+    Com bytes (ex.: response.content), o orjson decodifica o UTF-8 diretamente,
+    sem a conversão intermediária para str.
     """
     try:
-        # A resposta do SharePoint tem um formato que precisa ser corrigido antes do json.loads
-        # Encontra o primeiro colchete abrindo e o último fechando para isolar o JSON
-        start = texto_json.find('[')
-        end = texto_json.rfind(']')
-        if start != -1 and end != -1:
-            texto_json = texto_json[start:end+1]
-        
-        dados = json.loads(texto_json)
-        return dados
+        # Caminho rápido: resposta já em JSON válido (sem cópias/recortes)
+        return orjson.loads(texto_json)
+    except orjson.JSONDecodeError:
+        pass
+
+    # Recuperação: a resposta do SharePoint pode vir com conteúdo ao redor do JSON.
+    # Encontra o primeiro colchete abrindo e o último fechando para isolar o JSON
+    abre, fecha = (b'[', b']') if isinstance(texto_json, bytes) else ('[', ']')
+    start = texto_json.find(abre)
+    end = texto_json.rfind(fecha)
+    if start != -1 and end != -1:
+        texto_json = texto_json[start:end+1]
+
+    try:
+        return orjson.loads(texto_json)
+    except orjson.JSONDecodeError:
+        pass
+
+    try:
+        # Último recurso: o json da stdlib com strict=False aceita caracteres de
+        # controle crus dentro das strings (rejeitados pelo orjson)
+        return json.loads(texto_json, strict=False)
     except json.JSONDecodeError as e:
-        print(f"❌ Erro de Desserialização JSON: Não foi possível converter a string em JSON.")
-        # print(f"Trecho com problema: {texto_json[:200]}...")
+        logger.error(f"❌ Erro de Desserialização JSON: Não foi possível converter a string em JSON.")
         return None
     except Exception as e:
-        print(f"❌ Erro inesperado ao desserializar JSON: {e}")
+        logger.error(f"❌ Erro inesperado ao desserializar JSON: {e}")
         return None
 
 
 def extrair_resultados_recursivamente(dados: List[Dict[str, Any]]) -> List[Dict[str, str]]:
     """
-    Itera recursivamente sobre os dados, procurando por arrays 'ResultRows'
-    e extrai os campos 'Path' e 'PublishingPageContentOWSHTML'.
+    Percorre os dados (busca em profundidade iterativa, com pilha explícita),
+    procurando por arrays 'ResultRows' e extrai os campos 'Path' e
+    'PublishingPageContentOWSHTML'. Os ramos abaixo de um 'ResultRows' já
+    processado não são percorridos.
     """
     resultados_extraidos: List[Dict[str, str]] = []
 
-    def buscar_result_rows(item: Any):
+    # Os filhos são empilhados em ordem reversa para preservar a ordem original do documento
+    pilha = deque([dados])
+    while pilha:
+        item = pilha.pop()
+
         if isinstance(item, dict):
+            filhos = []
             for chave, valor in item.items():
                 if chave == 'ResultRows' and isinstance(valor, list):
                     for row in valor:
@@ -75,49 +188,236 @@ def extrair_resultados_recursivamente(dados: List[Dict[str, Any]]) -> List[Dict[
                                 'path': path,
                                 'conteudo': texto_concatenado
                             })
-                    return # Encontrou ResultRows, sai para não aprofundar desnecessariamente
-                else:
-                    buscar_result_rows(valor)
+                    continue # Encontrou ResultRows, não aprofunda desnecessariamente
+                if isinstance(valor, (dict, list)):
+                    filhos.append(valor)
+            pilha.extend(reversed(filhos))
         
         elif isinstance(item, list):
-            for elemento in item:
-                buscar_result_rows(elemento)
-
-    buscar_result_rows(dados)
+            pilha.extend(reversed(item))
     
-    print(f"✅ Extração Concluída. {len(resultados_extraidos)} Resultados base encontrados.")
+    logger.info(f"✅ Extração Concluída. {len(resultados_extraidos)} Resultados base encontrados.")
     return resultados_extraidos
 
 
-def processar_para_faiss(resultados: List[Dict[str, str]]) -> Dict[str, Any]:
+def extrair_resultados_em_fluxo(arquivo) -> Iterator[Dict[str, str]]:
+    """
+    Versão incremental (ijson) de extrair_resultados_recursivamente: lê o JSON
+    de um objeto arquivo (ex.: response.raw) e gera cada linha de 'ResultRows'
+    assim que ela termina de ser lida. Apenas a linha corrente fica em memória.
+    """
+    num_resultados = 0
+    construtor = None
+    prefixo_linha = None
+
+    for prefixo, evento, valor in ijson.parse(arquivo):
+        if construtor is None:
+            # Início de um item de um array 'ResultRows' (em qualquer profundidade)
+            if evento == 'start_map' and prefixo.endswith('.ResultRows.item'):
+                construtor = ijson.ObjectBuilder()
+                prefixo_linha = prefixo
+                construtor.event(evento, valor)
+            continue
+
+        construtor.event(evento, valor)
+        if evento != 'end_map' or prefixo != prefixo_linha:
+            continue
+
+        row = construtor.value
+        construtor = None
+        path = row.get('Path')
+        conteudo = row.get('PublishingPageContentOWSHTML')
+        if path and conteudo:
+            yield {
+                'id': num_resultados, # ID sequencial para mapear para o FAISS
+                'path': path,
+                'conteudo': f"PATH: {path}\nCONTEÚDO: {conteudo}"
+            }
+            num_resultados += 1
+
+    logger.info(f"✅ Extração Concluída. {num_resultados} Resultados base encontrados.")
+
+
+class _LeituraComCopia:
+    """
+    Objeto arquivo sobre a resposta em streaming que copia os bytes lidos para
+    um arquivo temporário no diretório do cache de respostas. Ao final, a cópia
+    é movida para o cache: a resposta completa nunca fica em memória.
+    """
+
+    def __init__(self, arquivo):
+        self.arquivo = arquivo
+        self.copia = _novo_arquivo_temporario_cache()
+
+    def read(self, tamanho: Optional[int] = None) -> bytes:
+        dados = self.arquivo.read(tamanho)
+        self.copia.write(dados)
+        return dados
+
+    def ler_restante(self) -> str:
+        # Copia o restante (se houver) em blocos; retorna o caminho da cópia completa
+        while self.read(TAMANHO_BLOCO_LEITURA):
+            pass
+        self.copia.close()
+        return self.copia.name
+
+    def publicar(self, termo_pesquisa: str):
+        # Move a cópia completa para o cache (só para respostas válidas)
+        os.replace(self.ler_restante(), _arquivo_cache_resposta(termo_pesquisa))
+
+    def descartar(self):
+        # Remove a cópia temporária (sem efeito se ela já foi movida para o cache)
+        self.copia.close()
+        with contextlib.suppress(OSError):
+            os.remove(self.copia.name)
+
+
+def _hash_conteudo(conteudo: str) -> str:
+    return hashlib.blake2b(conteudo.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def carregar_cache_embeddings() -> Dict[str, np.ndarray]:
+    """
+    Carrega o cache de embeddings {hash do conteúdo: vetor}.
+    O cache é descartado se tiver sido gerado por outro modelo ou precisão.
+    """
+    try:
+        with np.load(ARQUIVO_CACHE_EMBEDDINGS) as dados:
+            if str(dados['modelo']) != ASSINATURA_CACHE_EMBEDDINGS:
+                return {}
+            return dict(zip(dados['hashes'].tolist(), dados['vetores']))
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        logger.warning(f"⚠️ Cache de embeddings ignorado (arquivo inválido): {e}")
+        return {}
+
+
+def salvar_cache_embeddings(cache: Dict[str, np.ndarray]):
+    """
+    Persiste o cache de embeddings {hash do conteúdo: vetor} em disco.
+    O dicionário está em ordem de uso (mais recentes no fim): apenas as
+    últimas MAX_CACHE_EMBEDDINGS entradas são gravadas.
+    A gravação vai para um arquivo temporário (nome único: o pipeline pode
+    salvar de mais de uma thread) que substitui o cache de forma atômica.
+    """
+    if not cache:
+        return
+    hashes = list(cache.keys())[-MAX_CACHE_EMBEDDINGS:]
+    diretorio = os.path.dirname(os.path.abspath(ARQUIVO_CACHE_EMBEDDINGS))
+    arquivo_temporario = None
+    try:
+        # Com um arquivo aberto, o np.savez não acrescenta a extensão ".npz" ao nome
+        with tempfile.NamedTemporaryFile(dir=diretorio, suffix=".tmp", delete=False) as f:
+            arquivo_temporario = f.name
+            np.savez(
+                f,
+                modelo=np.array(ASSINATURA_CACHE_EMBEDDINGS),
+                hashes=np.array(hashes),
+                vetores=np.stack([cache[h] for h in hashes])
+            )
+        os.replace(arquivo_temporario, ARQUIVO_CACHE_EMBEDDINGS)
+    except Exception as e:
+        logger.warning(f"⚠️ Não foi possível salvar o cache de embeddings: {e}")
+        if arquivo_temporario is not None:
+            with contextlib.suppress(OSError):
+                os.remove(arquivo_temporario)
+
+
+def processar_para_faiss(resultados: Iterable[Dict[str, str]], modelo=None) -> Dict[str, Any]:
     """
     Adiciona vetor (embedding REAL usando MiniLM/BERT) a cada resultado
     e prepara os dados para o FAISS.
+    'resultados' pode ser uma lista ou um gerador (extrair_resultados_em_fluxo).
     """
-    print("\n--- Processando Documentos para FAISS (Gerando Embeddings com MiniLM) ---")
-    if not resultados:
-        return {'vetores': np.array([]), 'metadados': []}
+    logger.info("\n--- Processando Documentos para FAISS (Gerando Embeddings com MiniLM) ---")
     
-    # 1. Extrai a lista de textos a serem vetorizados e IDs
-    textos = [item['conteudo'] for item in resultados]
-    
-    # 2. Geração dos Embeddings em Batch (Processamento eficiente)
-    # A saída é um numpy array
-    embeddings_array = MODELO_EMBEDDING.encode(textos, convert_to_numpy=True)
-    
-    # 3. Prepara os metadados (para mapeamento após a busca FAISS)
+    # 1. Extrai (em uma única passada) os textos a serem vetorizados e os
+    # metadados para mapeamento após a busca FAISS
+    textos = []
     metadados = []
     for item in resultados:
+        textos.append(item['conteudo'])
         metadados.append({
             'id': item['id'],
             'path': item['path'],
             'conteudo': item['conteudo'],
         })
+    
+    if not textos:
+        return {'vetores': np.array([]), 'metadados': []}
+    
+    # 2. Separa os documentos já vetorizados (cache por hash do conteúdo) dos novos
+    hashes = [_hash_conteudo(texto) for texto in textos]
+    cache_embeddings = carregar_cache_embeddings()
+    indices_novos = [i for i, h in enumerate(hashes) if h not in cache_embeddings]
+    
+    # 3. Geração dos Embeddings em Batch apenas para os documentos novos/alterados
+    # A saída é um numpy array float32 C-contíguo, já normalizado em L2
+    # (produto interno ≡ similaridade de cosseno)
+    # (lotes de 128 em todos os núcleos da CPU, ou distribuídos entre as GPUs)
+    if indices_novos:
+        novos = gerar_embeddings_corpus([textos[i] for i in indices_novos], modelo=modelo, normalize_embeddings=True)
+        for i, vetor in zip(indices_novos, novos):
+            cache_embeddings[hashes[i]] = vetor
+    # Move os documentos do corpus atual para o fim (mais recentes), para que
+    # sobrevivam ao limite de tamanho do cache. Grava se houve vetores novos ou
+    # se a ordem mudou (também quando todos os documentos vieram do cache)
+    hashes_unicos = list(dict.fromkeys(hashes))
+    ordem_anterior = list(cache_embeddings)[-len(hashes_unicos):]
+    for h in hashes_unicos:
+        cache_embeddings[h] = cache_embeddings.pop(h)
+    if indices_novos or ordem_anterior != hashes_unicos:
+        salvar_cache_embeddings(cache_embeddings)
+    logger.info(f"   {len(textos) - len(indices_novos)} embeddings reaproveitados do cache, {len(indices_novos)} gerados.")
+    
+    if len(indices_novos) == len(textos):
+        # Nenhum documento em cache: usa diretamente a saída do encode (sem cópia)
+        embeddings_array = novos
+    else:
+        # Monta a matriz final em uma única alocação float32 C-contígua
+        embeddings_array = np.empty((len(textos), len(cache_embeddings[hashes[0]])), dtype=np.float32)
+        for i, h in enumerate(hashes):
+            embeddings_array[i] = cache_embeddings[h]
+    
+    # O FAISS recebe esta matriz diretamente (sem np.ascontiguousarray/astype)
+    assert embeddings_array.dtype == np.float32 and embeddings_array.flags['C_CONTIGUOUS']
         
-    print(f"✅ {len(embeddings_array)} Embeddings gerados com sucesso (dimensão {embeddings_array.shape[1]}).")
+    logger.info(f"✅ {len(embeddings_array)} Embeddings gerados com sucesso (dimensão {embeddings_array.shape[1]}).")
     return {'vetores': embeddings_array, 'metadados': metadados}
 
 
+def criar_indice_faiss(vetores: np.ndarray):
+    """
+    Cria e popula o índice FAISS adequado ao tamanho do corpus.
+    Todos usam produto interno sobre vetores normalizados (≡ cosseno):
+    corpora pequenos usam IndexFlatIP (busca exata), os médios HNSW (busca
+    aproximada em grafo) e os grandes IVFPQ (memória comprimida, busca em
+    'nprobe' listas).
+    """
+    num_vetores, dimensao = vetores.shape
+
+    if num_vetores >= IVFPQ_MIN_VETORES:
+        # IVFPQ: cada vetor é comprimido para IVFPQ_M bytes (~32x menos memória que float32)
+        # e apenas as listas invertidas mais próximas da query são varridas.
+        nlist = int(4 * np.sqrt(num_vetores))
+        quantizer = faiss.IndexFlatIP(dimensao)
+        index = faiss.IndexIVFPQ(quantizer, dimensao, nlist, IVFPQ_M, IVFPQ_NBITS, faiss.METRIC_INNER_PRODUCT)
+        index.train(vetores)
+    elif num_vetores >= HNSW_MIN_VETORES:
+        # HNSW: busca aproximada em grafo, complexidade logarítmica.
+        # A busca exata faz uma varredura O(N·d) a cada consulta; o HNSW
+        # visita apenas uma fração dos vetores mantendo recall próximo de 0.95.
+        index = faiss.IndexHNSWFlat(dimensao, HNSW_M, faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+    else:
+        # IndexFlatIP: busca exata; o produto interno dispensa o termo de norma do L2
+        index = faiss.IndexFlatIP(dimensao)
+
+    index.add(vetores)
+    return index
+
+
 def construir_e_salvar_indice_faiss(dados_processados: Dict[str, Any], nome_base_arquivo: str):
     """
     Constrói e salva o índice FAISS, e salva os metadados separadamente.
@@ -126,118 +426,752 @@ def construir_e_salvar_indice_faiss(dados_processados: Dict[str, Any], nome_base
     metadados = dados_processados['metadados']
     
     if vetores.size == 0:
-        print("⚠️ Não há vetores para indexar no FAISS.")
+        logger.warning("⚠️ Não há vetores para indexar no FAISS.")
         return
 
     dimensao = vetores.shape[1]
     num_vetores = vetores.shape[0]
 
-    print(f"\n--- Construindo Índice FAISS (Dimensão: {dimensao}, Vetores: {num_vetores}) ---")
+    logger.info(f"\n--- Construindo Índice FAISS (Dimensão: {dimensao}, Vetores: {num_vetores}) ---")
     
-    # Criação do Índice FAISS Simples (Flat Index - busca exata por similaridade)
-    # IndexFlatL2 usa a distância L2 (distância Euclidiana), que é a métrica padrão
-    # quando embeddings são normalizados, como os do MiniLM.
-    # Para embeddings normalizados, L2 é equivalente a Cosine Similarity.
-    index = faiss.IndexFlatL2(dimensao)
-    
-    # Adiciona os vetores ao índice
-    # É necessário garantir que os vetores sejam contíguos (np.ascontiguousarray)
-    index.add(np.ascontiguousarray(vetores).astype('float32'))
+    # Os vetores já chegam float32, C-contíguos e normalizados (processar_para_faiss),
+    # portanto são passados ao FAISS sem cópias adicionais.
+    # Criação e população do Índice FAISS (FlatIP, HNSW ou IVFPQ, conforme o tamanho do corpus)
+    index = criar_indice_faiss(vetores)
     
     # --- Salvamento ---
+    # Ordem de escrita: conteúdo primeiro e o índice FAISS por último
+    # (substituição atômica). Um processo de busca recarrega ao ver o novo .faiss
+    # (BuscaFaiss.py compara o mtime) e, nesse momento, os demais arquivos já
+    # correspondem a ele.
     
-    # 1. Salvar o Índice FAISS
-    nome_indice = f"{nome_base_arquivo}.faiss"
+    # 1. Salvar Path/Conteúdo fora de linha (binário + offsets) para leitura via mmap
+    # na busca, materializando apenas as linhas retornadas pelo FAISS. Não há mais
+    # um _metadados.json com o conteúdo duplicado (BuscaFaiss.py só o lê para
+    # índices antigos); o de uma construção anterior é removido.
+    nome_conteudo = f"{nome_base_arquivo}_conteudo.bin"
+    nome_offsets = f"{nome_base_arquivo}_offsets.npy"
     try:
-        faiss.write_index(index, nome_indice)
-        print(f"✅ Índice FAISS (IndexFlatL2) salvo com sucesso: {nome_indice}")
+        # offsets[i] = (início do path, fim do path/início do conteúdo, fim do conteúdo)
+        offsets = np.empty((len(metadados), 3), dtype=np.int64)
+        posicao = 0
+        # Grava em arquivos temporários e substitui atomicamente: um processo que
+        # mantenha o arquivo anterior mapeado (BuscaFaiss.py --serve) não é afetado.
+        with open(f"{nome_conteudo}.tmp", 'wb') as f:
+            for i, item in enumerate(metadados):
+                path_bytes = item['path'].encode('utf-8')
+                conteudo_bytes = item['conteudo'].encode('utf-8')
+                f.write(path_bytes)
+                f.write(conteudo_bytes)
+                offsets[i] = (posicao, posicao + len(path_bytes), posicao + len(path_bytes) + len(conteudo_bytes))
+                posicao = offsets[i, 2]
+        with open(f"{nome_offsets}.tmp", 'wb') as f:
+            np.save(f, offsets)
+        os.replace(f"{nome_conteudo}.tmp", nome_conteudo)
+        os.replace(f"{nome_offsets}.tmp", nome_offsets)
+        logger.info(f"✅ Conteúdo dos documentos salvo para acesso aleatório: {nome_conteudo}")
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(f"{nome_base_arquivo}_metadados.json")
     except Exception as e:
-        print(f"❌ Erro ao salvar o índice FAISS: {e}")
+        # Sem o conteúdo correspondente, o índice novo não é publicado
+        logger.error(f"❌ Erro ao salvar o conteúdo binário: {e}")
+        return
 
-    # 2. Salvar os Metadados (ID sequencial + Conteúdo)
-    nome_metadados = f"{nome_base_arquivo}_metadados.json"
+    # 2. Salvar o Índice FAISS (arquivo temporário + substituição atômica)
+    # O cache semântico de consultas (BuscaFaiss.py) guarda a assinatura do índice
+    # e é descartado na carga apenas se o índice reconstruído for diferente.
+    nome_indice = f"{nome_base_arquivo}.faiss"
     try:
-        with open(nome_metadados, 'w', encoding='utf-8') as f:
-            json.dump(metadados, f, ensure_ascii=False, indent=4)
-        print(f"✅ Metadados dos documentos salvos com sucesso: {nome_metadados}")
+        faiss.write_index(index, f"{nome_indice}.tmp")
+        os.replace(f"{nome_indice}.tmp", nome_indice)
+        logger.info(f"✅ Índice FAISS ({type(index).__name__}) salvo com sucesso: {nome_indice}")
     except Exception as e:
-        print(f"❌ Erro ao salvar os metadados: {e}")
+        logger.error(f"❌ Erro ao salvar o índice FAISS: {e}")
         
-    print("\n--- PRÓXIMA ETAPA RAG ---")
-    print("Para usar o RAG, você deve carregar o índice FAISS e os metadados, vetorizar a consulta e buscar os K vizinhos mais próximos.")
+    logger.info("\n--- PRÓXIMA ETAPA RAG ---")
+    logger.info("Para usar o RAG, você deve carregar o índice FAISS e os metadados, vetorizar a consulta e buscar os K vizinhos mais próximos.")
 
 
 # =====================================================================
 # ETAPA 2: Código Original (Requisição)
 # =====================================================================
 
-def fazer_requisicao_fazenda_sp(termo_pesquisa):
-    # [A função de requisição HTTP é mantida, exceto pela remoção do digest hardcoded
-    # e uma nota sobre o problema]
-    url = "https://legislacao.fazenda.sp.gov.br/_vti_bin/client.svc/ProcessQuery"
-    headers = {
-        "User-Agent": "Mozilla/5.0 (X11; Linux x86_64; rv:128.0) Gecko/20100101 Firefox/128.0",
-        "Accept": "*/*",
-        "Accept-Language": "en-US,en;q=0.5",
-        "X-Requested-With": "XMLHttpRequest",
-        "Content-Type": "text/xml",
-        # O cabeçalho 'X-RequestDigest' é dinâmico. O valor hardcoded abaixo
-        # quase sempre resultará em um erro 403.
-        # Para um código de produção, você precisaria de uma requisição inicial
-        # para obter o valor dinâmico.
-        # Por simplicidade neste exemplo de FAISS, mantemos o valor de placeholder.
-        "X-RequestDigest": "0x00,27 Oct 2025 23:00:32 -0000",
-        "Sec-Fetch-Dest": "empty",
-        "Sec-Fetch-Mode": "cors",
-        "Sec-Fetch-Site": "same-origin",
-        "Referer": "https://legislacao.fazenda.sp.gov.br/Paginas/Search.aspx?"
-    }
-
-    xml_body = f"""<Request xmlns="http://schemas.microsoft.com/sharepoint/clientquery/2009" SchemaVersion="15.0.0.0" LibraryVersion="16.0.0.0" ApplicationName="Javascript Library"><Actions><ObjectPath Id="95" ObjectPathId="94" /><SetProperty Id="96" ObjectPathId="94" Name="TimeZoneId"><Parameter Type="Number">8</Parameter></SetProperty><SetProperty Id="97" ObjectPathId="94" Name="QueryText"><Parameter Type="String">{termo_pesquisa}</Parameter></SetProperty><SetProperty Id="98" ObjectPathId="94" Name="QueryTemplate"><Parameter Type="String">{{{{searchboxquery}}}} PublishingPageLayoutOWSURLH:"PesqLegisManterAto" OR TipoOWSCHCS:"Leis Complementares Federais" OR TipoOWSCHCS:"Respostas de Consultas"</Parameter></SetProperty><SetProperty Id="99" ObjectPathId="94" Name="Culture"><Parameter Type="Number">1046</Parameter></SetProperty><SetProperty Id="100" ObjectPathId="94" Name="RowsPerPage"><Parameter Type="Number">30</Parameter></SetProperty><SetProperty Id="101" ObjectPathId="94" Name="RowLimit"><Parameter Type="Number">30</Parameter></SetProperty><SetProperty Id="102" ObjectPathId="94" Name="TotalRowsExactMinimum"><Parameter Type="Number">31</Parameter></SetProperty><SetProperty Id="103" ObjectPathId="94" Name="SourceId"><Parameter Type="Guid">{{8413cd39-2156-4e00-b54d-11efd9abdb89}}</Parameter></SetProperty><ObjectPath Id="105" ObjectPathId="104" /><Method Name="SetQueryPropertyValue" Id="106" ObjectPathId="104"><Parameters><Parameter Type="String">SourceName</Parameter><Parameter TypeId="{{b25ba502-71d7-4ae4-a701-4ca2fb1223be}}"><Property Name="BoolVal" Type="Boolean">false</Property><Property Name="IntVal" Type="Number">0</Property><Property Name="QueryPropertyValueTypeIndex" Type="Number">1</Property><Property Name="StrArray" Type="Null" /><Property Name="StrVal" Type="String">Local SharePoint Results</Property></Parameter></Parameters></Method><Method Name="SetQueryPropertyValue" Id="107" ObjectPathId="104"><Parameters><Parameter Type="String">SourceLevel</Parameter><Parameter TypeId="{{b25ba502-71d7-4ae4-a701-4ca2fb1223be}}"><Property Name="BoolVal" Type="Boolean">false</Property><Property Name="IntVal" Type="Number">0</Property><Property Name="QueryPropertyValueTypeIndex" Type="Number">1</Property><Property Name="StrArray" Type="Null" /><Property Name="StrVal" Type="String">Ssa</Property></Parameter></Parameters></Method><SetProperty Id="108" ObjectPathId="94" Name="Refiners"><Parameter Type="String">PesqLegisTipo(deephits=100000,sort=name/descending,filter=15/0/*),PesqLegisRCSubTema(deephits=100000,filter=15/0/*),PesqLegisTributo(deephits=100000,sort=name/descending,filter=15/0/*),PesqLegisDataAto(deephits=100000),PesqLegisRCTema(deephits=100000,filter=15/0/*),PesqLegisRCTributo(deephits=100000,filter=15/0/*)</Parameter></SetProperty><ObjectPath Id="110" ObjectPathId="109" /><Method Name="Add" Id="111" ObjectPathId="109"><Parameters><Parameter Type="String">Title</Parameter></Parameters></Method><Method Name="Add" Id="112" ObjectPathId="109"><Parameters><Parameter Type="String">Path</Parameter></Parameters></Method><Method Name="Add" Id="113" ObjectPathId="109"><Parameters><Parameter Type="String">Author</Parameter></Parameters></Method><Method Name="Add" Id="114" ObjectPathId="109"><Parameters><Parameter Type="String">SectionNames</Parameter></Parameters></Method><Method Name="Add" Id="115" ObjectPathId="109"><Parameters><Parameter Type="String">SiteDescription</Parameter></Parameters></Method><SetProperty Id="116" ObjectPathId="94" Name="RankingModelId"><Parameter Type="String">8f6fd0bc-06f9-43cf-bbab-08c377e083f4</Parameter></SetProperty><SetProperty Id="117" ObjectPathId="94" Name="TrimDuplicates"><Parameter Type="Boolean">false</Parameter></SetProperty><Method Name="SetQueryPropertyValue" Id="118" ObjectPathId="104"><Parameters><Parameter Type="String">ListId</Parameter><Parameter TypeId="{{b25ba502-71d7-4ae4-a701-4ca2fb1223be}}"><Property Name="BoolVal" Type="Boolean">false</Property><Property Name="IntVal" Type="Number">0</Property><Property Name="QueryPropertyValueTypeIndex" Type="Number">1</Property><Property Name="StrArray" Type="Null" /><Property Name="StrVal" Type="String">f286d0d1-5624-47da-a856-a8571296eb7f</Property></Parameter></Parameters></Method><Method Name="SetQueryPropertyValue" Id="119" ObjectPathId="104"><Parameters><Parameter Type="String">ListItemId</Parameter><Parameter TypeId="{{b25ba502-71d7-4ae4-a701-4ca2fb1223be}}"><Property Name="BoolVal" Type="Boolean">false</Property><Property Name="IntVal" Type="Number">1245670</Property><Property Name="QueryPropertyValueTypeIndex" Type="Number">2</Property><Property Name="StrArray" Type="Null" /><Property Name="StrVal" Type="Null" /></Parameter></Parameters></Method><Method Name="SetQueryPropertyValue" Id="120" ObjectPathId="104"><Parameters><Parameter Type="String">CrossGeoQuery</Parameter><Parameter TypeId="{{b25ba502-71d7-4ae4-a701-4ca2fb1223be}}"><Property Name="BoolVal" Type="Boolean">false</Property><Property Name="IntVal" Type="Number">0</Property><Property Name="QueryPropertyValueTypeIndex" Type="Number">1</Property><Property Name="StrArray" Type="Null" /><Property Name="StrVal" Type="String">false</Property></Parameter></Parameters></Method><SetProperty Id="121" ObjectPathId="94" Name="ResultsUrl"><Parameter Type="String">https://legislacao.fazenda.sp.gov.br/Paginas/Search.aspx?#k={termo_pesquisa}</Parameter></SetProperty><SetProperty Id="122" ObjectPathId="94" Name="ClientType"><Parameter Type="String">UI</Parameter></SetProperty><SetProperty Id="123" ObjectPathId="94" Name="ProcessBestBets"><Parameter Type="Boolean">false</Parameter></SetProperty><Method Name="SetQueryPropertyValue" Id="124" ObjectPathId="104"><Parameters><Parameter Type="String">QuerySession</Parameter><Parameter TypeId="{{b25ba502-71d7-4ae4-a701-4ca2fb1223be}}"><Property Name="BoolVal" Type="Boolean">false</Property><Property Name="IntVal" Type="Number">0</Property><Property Name="QueryPropertyValueTypeIndex" Type="Number">1</Property><Property Name="StrArray" Type="Null" /><Property Name="StrVal" Type="String">770d0626-c5e9-4468-806f-763ae6dca132</Property></Parameter></Parameters></Method><SetProperty Id="125" ObjectPathId="94" Name="ProcessPersonalFavorites"><Parameter Type="Boolean">false</Parameter></SetProperty><SetProperty Id="126" ObjectPathId="94" Name="SafeQueryPropertiesTemplateUrl"><Parameter Type="String">querygroup://webroot/Paginas/Search.aspx?groupname=Default</Parameter></SetProperty><SetProperty Id="127" ObjectPathId="94" Name="IgnoreSafeQueryPropertiesTemplateUrl"><Parameter Type="Boolean">false</Parameter></SetProperty><Method Name="SetQueryPropertyValue" Id="128" ObjectPathId="104"><Parameters><Parameter Type="String">QueryDateTimeCulture</Parameter><Parameter TypeId="{{b25ba502-71d7-4ae4-a701-4ca2fb1223be}}"><Property Name="BoolVal" Type="Boolean">false</Property><Property Name="IntVal" Type="Number">1046</Property><Property Name="QueryPropertyValueTypeIndex" Type="Number">2</Property><Property Name="StrArray" Type="Null" /><Property Name="StrVal" Type="Null" /></Parameter></Parameters></Method><ObjectPath Id="130" ObjectPathId="129" /><ExceptionHandlingScope Id="131"><TryScope Id="133"><Method Name="ExecuteQueries" Id="135" ObjectPathId="129"><Parameters><Parameter Type="Array"><Object Type="String">dae87cb5-3265-470f-a15e-f0162a26a113Default</Object></Parameter><Parameter Type="Array"><Object ObjectPathId="94" /></Parameter><Parameter Type="Boolean">true</Parameter></Parameters></Method></TryScope><CatchScope Id="137" /></ExceptionHandlingScope></Actions><ObjectPaths><Constructor Id="94" TypeId="{{80173281-fffd-47b6-9a49-312e06ff8428}}" /><Property Id="104" ParentId="94" Name="Properties" /><Property Id="109" ParentId="94" Name="HitHighlightedProperties" /><Constructor Id="129" TypeId="{{8d2ac302-db2f-46fe-9015-872b35f15098}}" /></ObjectPaths></Request>"""
-
-    print(f"Fazendo requisição para o termo: '{termo_pesquisa}'...")
+# Endpoint CSOM do SharePoint da Legislação da Fazenda SP
+URL_PROCESS_QUERY = "https://legislacao.fazenda.sp.gov.br/_vti_bin/client.svc/ProcessQuery"
+
+# Cabeçalhos fixos de todas as requisições (o digest é tratado à parte)
+HEADERS_PADRAO = {
+    "User-Agent": "Mozilla/5.0 (X11; Linux x86_64; rv:128.0) Gecko/20100101 Firefox/128.0",
+    "Accept": "*/*",
+    "Accept-Language": "en-US,en;q=0.5",
+    # Respostas JSON da busca comprimem bem (~5-10x); 'br' só é anunciado se puder ser descomprimido
+    "Accept-Encoding": "gzip, br" if brotli is not None else "gzip, deflate",
+    "X-Requested-With": "XMLHttpRequest",
+    "Content-Type": "text/xml",
+    "Sec-Fetch-Dest": "empty",
+    "Sec-Fetch-Mode": "cors",
+    "Sec-Fetch-Site": "same-origin",
+    "Referer": "https://legislacao.fazenda.sp.gov.br/Paginas/Search.aspx?"
+}
+
+# O cabeçalho 'X-RequestDigest' é dinâmico: obtido em /_api/contextinfo e
+# reutilizado até pouco antes de expirar (evita um 403 e uma requisição extra por busca).
+URL_CONTEXT_INFO = "https://legislacao.fazenda.sp.gov.br/_api/contextinfo"
+HEADERS_CONTEXT_INFO = {"Accept": "application/json;odata=verbose"}
+MARGEM_EXPIRACAO_DIGEST_SEGUNDOS = 30
+_digest: Optional[str] = None
+_digest_expira_em = 0.0
+# Protege só a leitura/gravação das variáveis acima; nunca é mantida durante a
+# requisição ao /_api/contextinfo.
+_trava_digest = threading.Lock()
+# Serializa a obtenção síncrona do digest (aquecimento em segundo plano x primeira
+# busca): quem chega enquanto outra obtenção está em andamento espera (com tempo
+# limite) e reutiliza o resultado.
+_trava_busca_digest = threading.Lock()
+TIMEOUT_TRAVA_DIGEST_SEGUNDOS = 20
+
+# Retentativas (sessão síncrona e assíncrona) para limites de taxa e falhas do servidor
+STATUS_RETENTAVEIS = [429, 500, 502, 503, 504]
+MAX_TENTATIVAS = 3
+BACKOFF_SEGUNDOS = 0.3
+
+# Cache em disco das respostas da busca (a resposta é estável para um mesmo termo
+# em janelas curtas): repetições viram leitura local em vez de um POST HTTPS.
+# Um arquivo por termo (nome = sha1 do termo); a validade é dada pelo mtime.
+DIRETORIO_CACHE_RESPOSTAS = ".fazsp_respostas"
+TTL_CACHE_RESPOSTAS_SEGUNDOS = 6 * 60 * 60
+TAMANHO_BLOCO_LEITURA = 64 * 1024  # Blocos de leitura ao copiar o restante de uma resposta
+
+# Busca concorrente de vários termos (aiohttp)
+MAX_REQUISICOES_CONCORRENTES = 16
+
+# Termos enviados juntos em uma única chamada ExecuteQueries (um POST para o lote)
+TAMANHO_LOTE_CONSULTAS = 8
+
+# Capacidade das filas entre as etapas do pipeline (requisição → embeddings → índice):
+# limita quantas respostas/matrizes ficam em memória aguardando a etapa seguinte.
+TAMANHO_FILA_PIPELINE = 4
+
+# Sessão HTTP compartilhada: mantém a conexão TLS aberta (keep-alive) entre as
+# requisições, evitando um novo handshake TCP+TLS a cada chamada.
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=32,
+    max_retries=Retry(
+        total=MAX_TENTATIVAS,
+        backoff_factor=BACKOFF_SEGUNDOS,
+        status_forcelist=STATUS_RETENTAVEIS,
+        allowed_methods=frozenset({"POST"}), # A consulta de busca é somente leitura
+        raise_on_status=False # Após as tentativas, raise_for_status() trata o erro
+    )
+))
+_SESSION.headers.update(HEADERS_PADRAO)
+atexit.register(_SESSION.close)
+
+
+def aquecer_conexao():
+    """
+    Resolve o DNS do servidor e abre a conexão TLS do pool antes da primeira
+    busca. A requisição de aquecimento é a do X-RequestDigest, que já é
+    necessária de qualquer forma (e fica em cache).
+    """
+    try:
+        socket.getaddrinfo(urlsplit(URL_PROCESS_QUERY).hostname, 443, type=socket.SOCK_STREAM)
+        obter_digest()
+    except OSError as e:
+        logger.warning(f"⚠️ Aquecimento da conexão falhou: {e}")
+
+
+# Corpo XML da consulta CSOM (ProcessQuery), montado uma única vez na carga do módulo.
+# O termo pesquisado aparece duas vezes (QueryText e ResultsUrl), marcado pela sentinela;
+# o template é pré-codificado em bytes (prefixo/meio/sufixo) para o caminho quente.
+_SENTINELA_TERMO = "\x00TERM\x00"
+_XML_TEMPLATE = """<Request xmlns="http://schemas.microsoft.com/sharepoint/clientquery/2009" SchemaVersion="15.0.0.0" LibraryVersion="16.0.0.0" ApplicationName="Javascript Library"><Actions><ObjectPath Id="95" ObjectPathId="94" /><SetProperty Id="96" ObjectPathId="94" Name="TimeZoneId"><Parameter Type="Number">8</Parameter></SetProperty><SetProperty Id="97" ObjectPathId="94" Name="QueryText"><Parameter Type="String">\x00TERM\x00</Parameter></SetProperty><SetProperty Id="98" ObjectPathId="94" Name="QueryTemplate"><Parameter Type="String">{{searchboxquery}} PublishingPageLayoutOWSURLH:"PesqLegisManterAto" OR TipoOWSCHCS:"Leis Complementares Federais" OR TipoOWSCHCS:"Respostas de Consultas"</Parameter></SetProperty><SetProperty Id="99" ObjectPathId="94" Name="Culture"><Parameter Type="Number">1046</Parameter></SetProperty><SetProperty Id="100" ObjectPathId="94" Name="RowsPerPage"><Parameter Type="Number">30</Parameter></SetProperty><SetProperty Id="101" ObjectPathId="94" Name="RowLimit"><Parameter Type="Number">30</Parameter></SetProperty><SetProperty Id="102" ObjectPathId="94" Name="TotalRowsExactMinimum"><Parameter Type="Number">31</Parameter></SetProperty><SetProperty Id="103" ObjectPathId="94" Name="SourceId"><Parameter Type="Guid">{8413cd39-2156-4e00-b54d-11efd9abdb89}</Parameter></SetProperty><ObjectPath Id="105" ObjectPathId="104" /><Method Name="SetQueryPropertyValue" Id="106" ObjectPathId="104"><Parameters><Parameter Type="String">SourceName</Parameter><Parameter TypeId="{b25ba502-71d7-4ae4-a701-4ca2fb1223be}"><Property Name="BoolVal" Type="Boolean">false</Property><Property Name="IntVal" Type="Number">0</Property><Property Name="QueryPropertyValueTypeIndex" Type="Number">1</Property><Property Name="StrArray" Type="Null" /><Property Name="StrVal" Type="String">Local SharePoint Results</Property></Parameter></Parameters></Method><Method Name="SetQueryPropertyValue" Id="107" ObjectPathId="104"><Parameters><Parameter Type="String">SourceLevel</Parameter><Parameter TypeId="{b25ba502-71d7-4ae4-a701-4ca2fb1223be}"><Property Name="BoolVal" Type="Boolean">false</Property><Property Name="IntVal" Type="Number">0</Property><Property Name="QueryPropertyValueTypeIndex" Type="Number">1</Property><Property Name="StrArray" Type="Null" /><Property Name="StrVal" Type="String">Ssa</Property></Parameter></Parameters></Method><SetProperty Id="108" ObjectPathId="94" Name="Refiners"><Parameter Type="String">PesqLegisTipo(deephits=100000,sort=name/descending,filter=15/0/*),PesqLegisRCSubTema(deephits=100000,filter=15/0/*),PesqLegisTributo(deephits=100000,sort=name/descending,filter=15/0/*),PesqLegisDataAto(deephits=100000),PesqLegisRCTema(deephits=100000,filter=15/0/*),PesqLegisRCTributo(deephits=100000,filter=15/0/*)</Parameter></SetProperty><ObjectPath Id="110" ObjectPathId="109" /><Method Name="Add" Id="111" ObjectPathId="109"><Parameters><Parameter Type="String">Title</Parameter></Parameters></Method><Method Name="Add" Id="112" ObjectPathId="109"><Parameters><Parameter Type="String">Path</Parameter></Parameters></Method><Method Name="Add" Id="113" ObjectPathId="109"><Parameters><Parameter Type="String">Author</Parameter></Parameters></Method><Method Name="Add" Id="114" ObjectPathId="109"><Parameters><Parameter Type="String">SectionNames</Parameter></Parameters></Method><Method Name="Add" Id="115" ObjectPathId="109"><Parameters><Parameter Type="String">SiteDescription</Parameter></Parameters></Method><SetProperty Id="116" ObjectPathId="94" Name="RankingModelId"><Parameter Type="String">8f6fd0bc-06f9-43cf-bbab-08c377e083f4</Parameter></SetProperty><SetProperty Id="117" ObjectPathId="94" Name="TrimDuplicates"><Parameter Type="Boolean">false</Parameter></SetProperty><Method Name="SetQueryPropertyValue" Id="118" ObjectPathId="104"><Parameters><Parameter Type="String">ListId</Parameter><Parameter TypeId="{b25ba502-71d7-4ae4-a701-4ca2fb1223be}"><Property Name="BoolVal" Type="Boolean">false</Property><Property Name="IntVal" Type="Number">0</Property><Property Name="QueryPropertyValueTypeIndex" Type="Number">1</Property><Property Name="StrArray" Type="Null" /><Property Name="StrVal" Type="String">f286d0d1-5624-47da-a856-a8571296eb7f</Property></Parameter></Parameters></Method><Method Name="SetQueryPropertyValue" Id="119" ObjectPathId="104"><Parameters><Parameter Type="String">ListItemId</Parameter><Parameter TypeId="{b25ba502-71d7-4ae4-a701-4ca2fb1223be}"><Property Name="BoolVal" Type="Boolean">false</Property><Property Name="IntVal" Type="Number">1245670</Property><Property Name="QueryPropertyValueTypeIndex" Type="Number">2</Property><Property Name="StrArray" Type="Null" /><Property Name="StrVal" Type="Null" /></Parameter></Parameters></Method><Method Name="SetQueryPropertyValue" Id="120" ObjectPathId="104"><Parameters><Parameter Type="String">CrossGeoQuery</Parameter><Parameter TypeId="{b25ba502-71d7-4ae4-a701-4ca2fb1223be}"><Property Name="BoolVal" Type="Boolean">false</Property><Property Name="IntVal" Type="Number">0</Property><Property Name="QueryPropertyValueTypeIndex" Type="Number">1</Property><Property Name="StrArray" Type="Null" /><Property Name="StrVal" Type="String">false</Property></Parameter></Parameters></Method><SetProperty Id="121" ObjectPathId="94" Name="ResultsUrl"><Parameter Type="String">https://legislacao.fazenda.sp.gov.br/Paginas/Search.aspx?#k=\x00TERM\x00</Parameter></SetProperty><SetProperty Id="122" ObjectPathId="94" Name="ClientType"><Parameter Type="String">UI</Parameter></SetProperty><SetProperty Id="123" ObjectPathId="94" Name="ProcessBestBets"><Parameter Type="Boolean">false</Parameter></SetProperty><Method Name="SetQueryPropertyValue" Id="124" ObjectPathId="104"><Parameters><Parameter Type="String">QuerySession</Parameter><Parameter TypeId="{b25ba502-71d7-4ae4-a701-4ca2fb1223be}"><Property Name="BoolVal" Type="Boolean">false</Property><Property Name="IntVal" Type="Number">0</Property><Property Name="QueryPropertyValueTypeIndex" Type="Number">1</Property><Property Name="StrArray" Type="Null" /><Property Name="StrVal" Type="String">770d0626-c5e9-4468-806f-763ae6dca132</Property></Parameter></Parameters></Method><SetProperty Id="125" ObjectPathId="94" Name="ProcessPersonalFavorites"><Parameter Type="Boolean">false</Parameter></SetProperty><SetProperty Id="126" ObjectPathId="94" Name="SafeQueryPropertiesTemplateUrl"><Parameter Type="String">querygroup://webroot/Paginas/Search.aspx?groupname=Default</Parameter></SetProperty><SetProperty Id="127" ObjectPathId="94" Name="IgnoreSafeQueryPropertiesTemplateUrl"><Parameter Type="Boolean">false</Parameter></SetProperty><Method Name="SetQueryPropertyValue" Id="128" ObjectPathId="104"><Parameters><Parameter Type="String">QueryDateTimeCulture</Parameter><Parameter TypeId="{b25ba502-71d7-4ae4-a701-4ca2fb1223be}"><Property Name="BoolVal" Type="Boolean">false</Property><Property Name="IntVal" Type="Number">1046</Property><Property Name="QueryPropertyValueTypeIndex" Type="Number">2</Property><Property Name="StrArray" Type="Null" /><Property Name="StrVal" Type="Null" /></Parameter></Parameters></Method><ObjectPath Id="130" ObjectPathId="129" /><ExceptionHandlingScope Id="131"><TryScope Id="133"><Method Name="ExecuteQueries" Id="135" ObjectPathId="129"><Parameters><Parameter Type="Array"><Object Type="String">dae87cb5-3265-470f-a15e-f0162a26a113Default</Object></Parameter><Parameter Type="Array"><Object ObjectPathId="94" /></Parameter><Parameter Type="Boolean">true</Parameter></Parameters></Method></TryScope><CatchScope Id="137" /></ExceptionHandlingScope></Actions><ObjectPaths><Constructor Id="94" TypeId="{80173281-fffd-47b6-9a49-312e06ff8428}" /><Property Id="104" ParentId="94" Name="Properties" /><Property Id="109" ParentId="94" Name="HitHighlightedProperties" /><Constructor Id="129" TypeId="{8d2ac302-db2f-46fe-9015-872b35f15098}" /></ObjectPaths></Request>"""
+
+# Para consultar vários termos em um único POST, o template é dividido em blocos:
+# as ações e os ObjectPaths de cada consulta (KeywordQuery, Ids 94-128) são repetidos
+# com Ids deslocados, e o ExecuteQueries (Ids 129-137) recebe todas as consultas.
+_ID_CONSULTA = "dae87cb5-3265-470f-a15e-f0162a26a113Default"
+DESLOCAMENTO_IDS_CONSULTA = 100
+_inicio_acoes = _XML_TEMPLATE.index("<Actions>") + len("<Actions>")
+_inicio_execucao = _XML_TEMPLATE.index('<ObjectPath Id="130" ObjectPathId="129" />')
+_inicio_caminhos = _XML_TEMPLATE.index("<ObjectPaths>") + len("<ObjectPaths>")
+_inicio_executor = _XML_TEMPLATE.index('<Constructor Id="129"')
+_XML_ABERTURA = _XML_TEMPLATE[:_inicio_acoes]
+_XML_ACOES_CONSULTA = _XML_TEMPLATE[_inicio_acoes:_inicio_execucao]
+_XML_EXECUCAO = _XML_TEMPLATE[_inicio_execucao:_inicio_caminhos]
+_XML_CAMINHOS_CONSULTA = _XML_TEMPLATE[_inicio_caminhos:_inicio_executor]
+_XML_FECHAMENTO = _XML_TEMPLATE[_inicio_executor:]
+_XML_IDS_CONSULTAS = f'<Object Type="String">{_ID_CONSULTA}</Object>'
+_XML_OBJETOS_CONSULTAS = '<Object ObjectPathId="94" />'
+_REGEX_IDS_CSOM = re.compile(r'\b(Id|ObjectPathId|ParentId)="(\d+)"')
+
+
+def _id_consulta(i: int) -> str:
+    # A primeira consulta mantém o Id original (o corpo de um termo não muda)
+    return f"{_ID_CONSULTA}{i}" if i else _ID_CONSULTA
+
+
+def _deslocar_ids(bloco: str, deslocamento: int) -> str:
+    if not deslocamento:
+        return bloco
+    return _REGEX_IDS_CSOM.sub(lambda m: f'{m[1]}="{int(m[2]) + deslocamento}"', bloco)
+
+
+@lru_cache(maxsize=None)
+def _template_lote(num_termos: int) -> Tuple[bytes, ...]:
+    """
+    Partes fixas (pré-codificadas em bytes) do corpo de uma requisição com
+    'num_termos' consultas. Cada termo ocupa duas posições entre as partes.
+    """
+    deslocamentos = [i * DESLOCAMENTO_IDS_CONSULTA for i in range(num_termos)]
+    execucao = _XML_EXECUCAO.replace(
+        _XML_IDS_CONSULTAS,
+        "".join(f'<Object Type="String">{_id_consulta(i)}</Object>' for i in range(num_termos))
+    ).replace(
+        _XML_OBJETOS_CONSULTAS,
+        "".join(f'<Object ObjectPathId="{94 + d}" />' for d in deslocamentos)
+    )
+    xml = (
+        _XML_ABERTURA
+        + "".join(_deslocar_ids(_XML_ACOES_CONSULTA, d) for d in deslocamentos)
+        + execucao
+        + "".join(_deslocar_ids(_XML_CAMINHOS_CONSULTA, d) for d in deslocamentos)
+        + _XML_FECHAMENTO
+    )
+    return tuple(parte.encode("utf-8") for parte in xml.split(_SENTINELA_TERMO))
+
+
+def _montar_corpo_lote(termos: List[str]) -> bytes:
+    partes = _template_lote(len(termos))
+    corpo = [partes[0]]
+    for i, termo_pesquisa in enumerate(termos):
+        # Escapa &, < e > para que o termo não corrompa (nem injete) o XML
+        termo_escapado = xml_escape(termo_pesquisa).encode("utf-8")
+        corpo += [termo_escapado, partes[2 * i + 1], termo_escapado, partes[2 * i + 2]]
+    return b"".join(corpo)
+
+
+def _montar_corpo_requisicao(termo_pesquisa) -> bytes:
+    return _montar_corpo_lote([termo_pesquisa])
+
+
+def erro_csom(dados: Any) -> Optional[Any]:
+    """
+    Retorna o 'ErrorInfo' de uma resposta CSOM (primeiro elemento do array),
+    ou None se a requisição foi processada sem erro. O ProcessQuery responde
+    com HTTP 200 mesmo quando a consulta falha.
+    """
+    if isinstance(dados, list) and dados and isinstance(dados[0], dict):
+        return dados[0].get('ErrorInfo')
+    return None
+
+
+def separar_respostas_lote(texto_resposta: str, num_termos: int) -> List[Optional[str]]:
+    """
+    Divide a resposta de um ExecuteQueries com várias consultas: os resultados
+    de cada consulta vêm sob o respectivo Id ('...Default', '...Default1', ...).
+    Retorna, na ordem dos termos, um texto JSON por consulta (None se ausente),
+    no mesmo formato aceito por desserializar_json_resistente.
+    """
+    dados = desserializar_json_resistente(texto_resposta)
+    if not dados:
+        return [None] * num_termos
+    if erro_csom(dados):
+        logger.error(f"❌ Erro do SharePoint na consulta em lote: {erro_csom(dados)}")
+        return [None] * num_termos
+
+    ids = {_id_consulta(i): i for i in range(num_termos)}
+    por_consulta: Dict[int, Any] = {}
+    pilha = deque([dados])
+    while pilha:
+        item = pilha.pop()
+        if isinstance(item, dict):
+            for chave, valor in item.items():
+                if chave in ids:
+                    por_consulta[ids[chave]] = valor
+                elif isinstance(valor, (dict, list)):
+                    pilha.append(valor)
+        elif isinstance(item, list):
+            pilha.extend(item)
+
+    return [
+        orjson.dumps([por_consulta[i]]).decode("utf-8") if i in por_consulta else None
+        for i in range(num_termos)
+    ]
+
+
+def _guardar_digest(dados_contexto: Dict[str, Any], agora: float) -> str:
+    global _digest, _digest_expira_em
+    info = dados_contexto["d"]["GetContextWebInformation"]
+    with _trava_digest:
+        _digest = info["FormDigestValue"]
+        _digest_expira_em = agora + info["FormDigestTimeoutSeconds"]
+        return _digest
+
+
+def _digest_em_cache() -> Optional[str]:
+    # Digest em cache se ainda estiver dentro da validade (com margem), senão None
+    with _trava_digest:
+        if _digest is not None and _digest_expira_em > time.time() + MARGEM_EXPIRACAO_DIGEST_SEGUNDOS:
+            return _digest
+        return None
+
+
+# Cabeçalhos por requisição: apenas o digest, que muda raramente. O dicionário é
+# montado uma vez por digest e reutilizado (requests/aiohttp copiam ao mesclar
+# com os cabeçalhos fixos da sessão, sem alterá-lo).
+_HEADERS_SEM_DIGEST: Dict[str, str] = {}
+_headers_do_digest: Tuple[Optional[str], Dict[str, str]] = (None, _HEADERS_SEM_DIGEST)
+
+
+def _headers_digest(digest: Optional[str]) -> Dict[str, str]:
+    global _headers_do_digest
+    if not digest:
+        return _HEADERS_SEM_DIGEST
+    if _headers_do_digest[0] != digest:
+        _headers_do_digest = (digest, {"X-RequestDigest": digest})
+    return _headers_do_digest[1]
+
+
+def obter_digest() -> Optional[str]:
+    """
+    Retorna o X-RequestDigest em cache ou obtém um novo via /_api/contextinfo
+    (reutilizando a sessão keep-alive). Retorna None se não for possível obtê-lo.
+    """
+    digest = _digest_em_cache()
+    if digest is not None:
+        return digest
+    adquirida = _trava_busca_digest.acquire(timeout=TIMEOUT_TRAVA_DIGEST_SEGUNDOS)
+    try:
+        # Outra thread pode ter obtido o digest enquanto esta esperava a trava
+        digest = _digest_em_cache()
+        if digest is not None:
+            return digest
+        agora = time.time()
+        resposta = _SESSION.post(URL_CONTEXT_INFO, headers=HEADERS_CONTEXT_INFO, timeout=(3, 15))
+        resposta.raise_for_status()
+        return _guardar_digest(resposta.json(), agora)
+    except (requests.exceptions.RequestException, ValueError, KeyError) as err:
+        logger.warning(f"⚠️ Não foi possível obter o X-RequestDigest: {err}")
+        return None
+    finally:
+        if adquirida:
+            _trava_busca_digest.release()
+
+
+async def obter_digest_async(sessao) -> Optional[str]:
+    """
+    Versão assíncrona (aiohttp) de obter_digest, compartilhando o mesmo cache.
+    Não espera por nenhuma trava de thread (bloquearia o event loop): na pior
+    das hipóteses, repete a requisição ao contextinfo.
+    """
+    digest = _digest_em_cache()
+    if digest is not None:
+        return digest
+    agora = time.time()
+    try:
+        async with sessao.post(URL_CONTEXT_INFO, headers=HEADERS_CONTEXT_INFO) as resposta:
+            resposta.raise_for_status()
+            return _guardar_digest(await resposta.json(content_type=None), agora)
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError, KeyError) as err:
+        logger.warning(f"⚠️ Não foi possível obter o X-RequestDigest: {err}")
+        return None
+
+
+class RespostaEmCache(NamedTuple):
+    """
+    Resposta lida do cache em disco, com os mesmos campos usados da
+    requests.Response ('text' e 'status_code').
+    """
+    text: str
+    status_code: int = 200
+
+
+def _arquivo_cache_resposta(termo_pesquisa: str) -> str:
+    nome = hashlib.sha1(termo_pesquisa.encode("utf-8")).hexdigest()
+    return os.path.join(DIRETORIO_CACHE_RESPOSTAS, f"{nome}.json")
+
+
+def _novo_arquivo_temporario_cache():
+    # Criado no próprio diretório do cache, para que os.replace seja atômico
+    os.makedirs(DIRETORIO_CACHE_RESPOSTAS, exist_ok=True)
+    return tempfile.NamedTemporaryFile(dir=DIRETORIO_CACHE_RESPOSTAS, suffix=".tmp", delete=False)
+
 
+def ler_resposta_em_cache(termo_pesquisa: str) -> Optional[RespostaEmCache]:
+    """
+    Retorna a resposta em cache do termo, se existir e estiver dentro do TTL.
+    """
+    arquivo = _arquivo_cache_resposta(termo_pesquisa)
+    try:
+        if time.time() - os.path.getmtime(arquivo) >= TTL_CACHE_RESPOSTAS_SEGUNDOS:
+            return None
+        with open(arquivo, 'rb') as f:
+            return RespostaEmCache(text=f.read().decode("utf-8", errors="replace"))
+    except FileNotFoundError:
+        return None
+    except OSError as e:
+        logger.warning(f"⚠️ Cache de respostas indisponível: {e}")
+        return None
+
+
+def salvar_resposta_em_cache(termo_pesquisa: str, texto_resposta: Union[str, bytes]):
+    """
+    Armazena a resposta do termo no cache em disco (arquivo temporário +
+    substituição atômica). Chamada apenas para respostas já validadas
+    (preparar_dados_faiss / processar_resposta_em_fluxo).
+    """
+    if isinstance(texto_resposta, str):
+        texto_resposta = texto_resposta.encode("utf-8")
     try:
-        response = requests.post(url, headers=headers, data=xml_body)
+        with _novo_arquivo_temporario_cache() as f:
+            f.write(texto_resposta)
+        os.replace(f.name, _arquivo_cache_resposta(termo_pesquisa))
+    except OSError as e:
+        logger.warning(f"⚠️ Não foi possível salvar a resposta no cache: {e}")
+
+
+# Aquecimento em segundo plano: DNS + handshake TLS + digest ficam prontos
+# enquanto o restante da aplicação (modelo, Gemini) é carregado, sem bloquear a importação.
+threading.Thread(target=aquecer_conexao, name="aquecimento-http", daemon=True).start()
+
+
+def fazer_requisicao_fazenda_sp(termo_pesquisa, stream: bool = False):
+    """
+    Faz a requisição de um termo. A resposta não é gravada no cache aqui:
+    quem a processa grava depois de validá-la (com linhas de resultado e sem
+    ErrorInfo). Com stream=True, o corpo não é lido aqui.
+    """
+    # Respostas recentes do mesmo termo vêm do cache em disco (sem requisição HTTP)
+    resposta_em_cache = ler_resposta_em_cache(termo_pesquisa)
+    if resposta_em_cache is not None:
+        logger.info(f"Resposta do termo '{termo_pesquisa}' obtida do cache local.")
+        return resposta_em_cache
+
+    # Os cabeçalhos fixos ficam na sessão (_SESSION); aqui apenas o digest dinâmico.
+    xml_body = _montar_corpo_requisicao(termo_pesquisa)
+    headers = _headers_digest(obter_digest())
+
+    if logger.isEnabledFor(logging.INFO):
+        logger.info(f"Fazendo requisição para o termo: '{termo_pesquisa}'...")
+
+    try:
+        response = _SESSION.post(URL_PROCESS_QUERY, headers=headers, data=xml_body, timeout=(3, 15), stream=stream)
         response.raise_for_status()
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(f"   Content-Encoding: {response.headers.get('Content-Encoding', 'identity')}, "
+                        f"Content-Length: {response.headers.get('Content-Length', 'desconhecido')}")
+        if stream:
+            # response.raw entrega os bytes como vieram da rede: descomprime gzip/deflate na leitura
+            response.raw.decode_content = True
         return response
     except requests.exceptions.HTTPError as err:
-        print(f"❌ Erro HTTP: {err}")
-        print(f"Status Code: {response.status_code}")
-        print("Atenção: O erro 403 (Forbidden) é comum devido ao cabeçalho 'X-RequestDigest' expirar.")
+        # Com stream=True o corpo não foi lido: fecha para devolver a conexão ao pool
+        response.close()
+        logger.error(f"❌ Erro HTTP: {err}")
+        logger.error(f"Status Code: {response.status_code}")
+        logger.error("Atenção: O erro 403 (Forbidden) é comum devido ao cabeçalho 'X-RequestDigest' expirar.")
         return None
     except requests.exceptions.RequestException as err:
-        print(f"❌ Ocorreu um erro na requisição: {err}")
+        logger.error(f"❌ Ocorreu um erro na requisição: {err}")
+        return None
+
+
+async def _postar_consulta_async(sessao, xml_body: bytes, descricao: str, semaforo, digest: Optional[str] = None) -> Optional[str]:
+    """
+    POST assíncrono (aiohttp) no ProcessQuery: retorna o texto da resposta ou
+    None em caso de erro. Retenta com backoff exponencial em 429/5xx.
+    """
+    headers = _headers_digest(digest)
+
+    async with semaforo:
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(f"Fazendo requisição para {descricao}...")
+        for tentativa in range(MAX_TENTATIVAS + 1):
+            try:
+                async with sessao.post(URL_PROCESS_QUERY, headers=headers, data=xml_body) as resposta:
+                    if resposta.status in STATUS_RETENTAVEIS and tentativa < MAX_TENTATIVAS:
+                        await asyncio.sleep(BACKOFF_SEGUNDOS * (2 ** tentativa))
+                        continue
+                    resposta.raise_for_status()
+                    return await resposta.text()
+            except aiohttp.ClientResponseError as err:
+                logger.error(f"❌ Erro HTTP para {descricao}: {err}")
+                logger.error("Atenção: O erro 403 (Forbidden) é comum devido ao cabeçalho 'X-RequestDigest' expirar.")
+                return None
+            except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+                logger.error(f"❌ Ocorreu um erro na requisição para {descricao}: {err}")
+                return None
+    return None
+
+
+async def fazer_requisicao_fazenda_sp_async(sessao, termo_pesquisa, semaforo, digest: Optional[str] = None) -> Optional[str]:
+    """
+    Versão assíncrona (aiohttp) da requisição de um termo: retorna o texto da
+    resposta ou None em caso de erro.
+    """
+    return await _postar_consulta_async(
+        sessao, _montar_corpo_requisicao(termo_pesquisa), f"o termo '{termo_pesquisa}'", semaforo, digest
+    )
+
+
+async def fazer_requisicao_lote_async(sessao, termos: List[str], semaforo, digest: Optional[str] = None) -> List[Optional[str]]:
+    """
+    Consulta vários termos em uma única requisição (ExecuteQueries com uma
+    consulta por termo) e retorna a resposta de cada termo, na mesma ordem
+    (None para os que falharam).
+    """
+    if len(termos) == 1:
+        return [await fazer_requisicao_fazenda_sp_async(sessao, termos[0], semaforo, digest)]
+
+    texto_resposta = await _postar_consulta_async(
+        sessao, _montar_corpo_lote(termos), f"os termos {termos}", semaforo, digest
+    )
+    if texto_resposta is None:
+        return [None] * len(termos)
+
+    return separar_respostas_lote(texto_resposta, len(termos))
+
+
+async def respostas_conforme_chegam(termos: List[str]):
+    """
+    Gerador assíncrono de (índice do termo, texto da resposta ou None, True se
+    veio da rede), na ordem em que as respostas ficam prontas: primeiro as do cache em disco,
+    depois as requisições concorrentes (lotes de até TAMANHO_LOTE_CONSULTAS
+    termos por requisição, limitadas por um semáforo e reutilizando as
+    conexões keep-alive).
+    """
+    # Termos com resposta recente em cache não geram requisição
+    pendentes = []
+    for i, termo in enumerate(termos):
+        resposta_em_cache = ler_resposta_em_cache(termo)
+        if resposta_em_cache is not None:
+            yield i, resposta_em_cache.text, False
+        else:
+            pendentes.append(i)
+    if not pendentes:
+        return
+
+    semaforo = asyncio.Semaphore(MAX_REQUISICOES_CONCORRENTES)
+    conector = aiohttp.TCPConnector(limit_per_host=MAX_REQUISICOES_CONCORRENTES, keepalive_timeout=85)
+    timeout = aiohttp.ClientTimeout(sock_connect=3, sock_read=15)
+    async with aiohttp.ClientSession(connector=conector, headers=HEADERS_PADRAO, timeout=timeout) as sessao:
+        # Um único digest para todo o lote de requisições
+        digest = await obter_digest_async(sessao)
+
+        async def requisitar(indices):
+            textos = await fazer_requisicao_lote_async(sessao, [termos[i] for i in indices], semaforo, digest)
+            return zip(indices, textos)
+
+        lotes = [pendentes[i:i + TAMANHO_LOTE_CONSULTAS] for i in range(0, len(pendentes), TAMANHO_LOTE_CONSULTAS)]
+        for tarefa in asyncio.as_completed([requisitar(indices) for indices in lotes]):
+            for i, texto_resposta in await tarefa:
+                yield i, texto_resposta, True
+
+
+async def buscar_varios_termos(termos: List[str]) -> List[Optional[str]]:
+    """
+    Faz as requisições de todos os termos concorrentemente. Retorna os textos
+    das respostas na mesma ordem dos termos (None para as que falharam).
+    """
+    textos_resposta: List[Optional[str]] = [None] * len(termos)
+    async for i, texto_resposta, _ in respostas_conforme_chegam(termos):
+        textos_resposta[i] = texto_resposta
+    return textos_resposta
+
+
+def preparar_dados_faiss(texto_resposta: Union[str, bytes], modelo=None, termo_cache: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    """
+    Etapas 2 a 4 para a resposta de um termo: desserialização, extração e
+    embeddings. Retorna os dados prontos para o FAISS (ou None).
+    Com 'termo_cache' (resposta vinda da rede), a resposta é gravada no cache
+    somente se for válida: sem ErrorInfo e com ao menos uma linha de resultado.
+    """
+    # 2. Desserialização JSON Resistente
+    dados_json = desserializar_json_resistente(texto_resposta)
+
+    if not dados_json:
+        return None
+
+    if erro_csom(dados_json):
+        logger.error(f"❌ Erro do SharePoint na consulta: {erro_csom(dados_json)}")
         return None
 
+    # 3. Extração Recursiva dos Resultados (ID, Path + Conteúdo)
+    resultados_base = extrair_resultados_recursivamente(dados_json)
+
+    if not resultados_base:
+        logger.warning("⚠️ Nenhuma linha de resultado ('ResultRows') foi encontrada ou os campos estavam incompletos.")
+        return None
+
+    if termo_cache is not None:
+        salvar_resposta_em_cache(termo_cache, texto_resposta)
+
+    # 4. Processamento: Adiciona Vetor (Embedding Real/MiniLM) e prepara para FAISS
+    return processar_para_faiss(resultados_base, modelo=modelo)
+
+
+def processar_resposta(termo: str, texto_resposta: Union[str, bytes], modelo=None, salvar_em_cache: bool = False) -> bool:
+    """
+    Etapas 2 a 5 para a resposta de um termo: desserialização, extração,
+    embeddings e construção/salvamento do índice FAISS.
+    Com salvar_em_cache=True, a resposta válida é gravada no cache de respostas.
+    Retorna True se o índice foi construído.
+    """
+    dados_faiss = preparar_dados_faiss(texto_resposta, modelo=modelo, termo_cache=termo if salvar_em_cache else None)
+    if dados_faiss is None:
+        return False
+
+    # 5. Construção e Salvamento do Índice FAISS e Metadados
+    construir_e_salvar_indice_faiss(dados_faiss, f"faiss_index_{termo}")
+    return True
+
+
+def processar_resposta_em_fluxo(termo: str, resposta: requests.Response, modelo=None) -> bool:
+    """
+    Etapas 2 a 5 sobre uma resposta em streaming: as linhas de resultado são
+    extraídas (ijson) enquanto o corpo ainda é recebido, sem montar o JSON
+    inteiro em memória. Se o streaming falhar (JSON fora do formato esperado),
+    recorre ao parser resistente sobre a resposta completa.
+    Retorna True se o índice foi construído.
+    """
+    with resposta:
+        try:
+            leitura = _LeituraComCopia(resposta.raw)
+        except OSError as e:
+            logger.warning(f"⚠️ Cache de respostas indisponível ({e}); lendo a resposta inteira.")
+            return processar_resposta(termo, resposta.content, modelo=modelo, salvar_em_cache=True)
+
+        try:
+            try:
+                # 2 a 4. Extração incremental consumida diretamente pela geração de embeddings
+                dados_faiss = processar_para_faiss(extrair_resultados_em_fluxo(leitura), modelo=modelo)
+            except ijson.JSONError as e:
+                logger.warning(f"⚠️ Leitura incremental do JSON falhou ({e}); usando o parser resistente.")
+                with open(leitura.ler_restante(), 'rb') as f:
+                    conteudo = f.read()
+                # O parser resistente valida a resposta antes de gravá-la no cache
+                return processar_resposta(termo, conteudo, modelo=modelo, salvar_em_cache=True)
+
+            # Só respostas com linhas de resultado vão para o cache (uma resposta
+            # com ErrorInfo não tem 'ResultRows'); as demais são descartadas
+            if dados_faiss['vetores'].size > 0:
+                try:
+                    leitura.publicar(termo)
+                except OSError as e:
+                    logger.warning(f"⚠️ Não foi possível salvar a resposta no cache: {e}")
+        except (ErroLeituraUrllib3, OSError) as err:
+            logger.error(f"❌ Ocorreu um erro na leitura da resposta: {err}")
+            return False
+        finally:
+            leitura.descartar()
+
+    if dados_faiss['vetores'].size == 0:
+        logger.warning("⚠️ Nenhuma linha de resultado ('ResultRows') foi encontrada ou os campos estavam incompletos.")
+        return False
+
+    # 5. Construção e Salvamento do Índice FAISS e Metadados
+    construir_e_salvar_indice_faiss(dados_faiss, f"faiss_index_{termo}")
+    return True
+
+
+def construir_indice(termo: str, modelo=None) -> bool:
+    """
+    Executa o fluxo completo para um termo: requisição, desserialização,
+    extração, embeddings e construção/salvamento do índice FAISS.
+    Pode ser chamada diretamente (sem subprocess) reutilizando um modelo já
+    carregado. Retorna True se o índice foi construído.
+    """
+    # 1. Faz a Requisição HTTP (em streaming, se o ijson estiver disponível)
+    resposta = fazer_requisicao_fazenda_sp(termo, stream=ijson is not None)
+
+    if not resposta:
+        return False
+
+    logger.info("\n--- Resposta da Requisição ---")
+    logger.info(f"Status: {resposta.status_code}")
+
+    if not isinstance(resposta, requests.Response):
+        # Resposta do cache local: já validada quando foi gravada
+        return processar_resposta(termo, resposta.text, modelo=modelo)
+    if ijson is not None:
+        return processar_resposta_em_fluxo(termo, resposta, modelo=modelo)
+    # Passa os bytes (o orjson dispensa o decode de response.text)
+    return processar_resposta(termo, resposta.content, modelo=modelo, salvar_em_cache=True)
+
+
+async def _pipeline_indices(termos: List[str], modelo=None) -> Dict[str, bool]:
+    """
+    Pipeline produtor/consumidor com três etapas sobrepostas:
+    requisições (event loop) → extração + embeddings (thread) → índice FAISS (thread).
+    Enquanto um termo é vetorizado, as próximas respostas continuam chegando e o
+    índice do termo anterior é construído. As filas limitadas (TAMANHO_FILA_PIPELINE)
+    controlam o uso de memória quando uma etapa fica para trás.
+    """
+    loop = asyncio.get_running_loop()
+    fila_respostas: asyncio.Queue = asyncio.Queue(maxsize=TAMANHO_FILA_PIPELINE)
+    fila_indices: asyncio.Queue = asyncio.Queue(maxsize=TAMANHO_FILA_PIPELINE)
+    construidos = {termo: False for termo in termos}
+
+    async def produtor():
+        # 1. Requisições HTTP concorrentes, entregues à fila conforme chegam
+        try:
+            async for i, texto_resposta, da_rede in respostas_conforme_chegam(termos):
+                if texto_resposta is not None:
+                    await fila_respostas.put((termos[i], texto_resposta, da_rede))
+        finally:
+            await fila_respostas.put(None) # Sentinela: fim das respostas
+
+    async def vetorizador(executor):
+        # 2 a 4. Desserialização, extração e embeddings fora do event loop
+        while (item := await fila_respostas.get()) is not None:
+            termo, texto_resposta, da_rede = item
+            logger.info(f"\n--- Resposta da Requisição ('{termo}') ---")
+            dados_faiss = await loop.run_in_executor(
+                executor, preparar_dados_faiss, texto_resposta, modelo, termo if da_rede else None
+            )
+            if dados_faiss is not None:
+                await fila_indices.put((termo, dados_faiss))
+        await fila_indices.put(None)
+
+    async def indexador(executor):
+        # 5. Construção e salvamento do índice FAISS
+        while (item := await fila_indices.get()) is not None:
+            termo, dados_faiss = item
+            await loop.run_in_executor(executor, construir_e_salvar_indice_faiss, dados_faiss, f"faiss_index_{termo}")
+            construidos[termo] = True
+
+    # Uma thread por etapa: o modelo (PyTorch/ONNX) e o FAISS liberam o GIL
+    # nas partes pesadas, e o modelo carregado é compartilhado (sem processos extras).
+    with ThreadPoolExecutor(max_workers=1) as executor_embeddings, ThreadPoolExecutor(max_workers=1) as executor_indices:
+        await asyncio.gather(produtor(), vetorizador(executor_embeddings), indexador(executor_indices))
+    return construidos
+
+
+def construir_indices(termos: List[str], modelo=None) -> Dict[str, bool]:
+    """
+    Constrói um índice FAISS por termo. As requisições HTTP são feitas
+    concorrentemente (aiohttp) e sobrepostas à geração de embeddings e à
+    construção dos índices; sem aiohttp, os termos são processados em série.
+    Retorna {termo: True se o índice foi construído}.
+    """
+    if aiohttp is None:
+        return {termo: construir_indice(termo, modelo=modelo) for termo in termos}
+
+    return asyncio.run(_pipeline_indices(termos, modelo=modelo))
+
 
 if __name__ == "__main__":
+    configurar_log()
     if len(sys.argv) < 2:
-        print("Uso: python pesquisa_fazenda_sp.py <termo_de_pesquisa>")
-        print("Exemplo: python pesquisa_fazenda_sp.py borracha")
+        print("Uso: python Legislacao.py <termo_de_pesquisa> [<outro_termo> ...]")
+        print("Exemplo: python Legislacao.py borracha pneu")
         sys.exit(1)
     
-    termo = sys.argv[1]
-    
-    # 1. Faz a Requisição HTTP
-    resposta = fazer_requisicao_fazenda_sp(termo)
-
-    if resposta:
-        print("\n--- Resposta da Requisição ---")
-        print(f"Status: {resposta.status_code}")
-
-        # 2. Desserialização JSON Resistente
-        dados_json = desserializar_json_resistente(resposta.text)
-
-        if dados_json:
-            # 3. Extração Recursiva dos Resultados (ID, Path + Conteúdo)
-            resultados_base = extrair_resultados_recursivamente(dados_json)
-
-            if resultados_base:
-                # 4. Processamento: Adiciona Vetor (Embedding Real/MiniLM) e prepara para FAISS
-                dados_faiss = processar_para_faiss(resultados_base)
-                
-                # 5. Construção e Salvamento do Índice FAISS e Metadados
-                construir_e_salvar_indice_faiss(dados_faiss, f"faiss_index_{termo}")
-            else:
-                print("⚠️ Nenhuma linha de resultado ('ResultRows') foi encontrada ou os campos estavam incompletos.")
+    termos = sys.argv[1:]
+    if len(termos) == 1:
+        construir_indice(termos[0])
+    else:
+        construir_indices(termos)
@@ -0,0 +1,252 @@
+import os
+import sys
+from ConfiguracaoThreads import NUM_THREADS_TORCH # Antes de numpy/torch (variáveis OMP/MKL)
+import numpy as np
+from typing import List
+
+# =====================================================================
+# ETAPA 0: Importação e Configuração do Modelo de Embedding
+# (Compartilhado por Legislacao.py e BuscaFaiss.py)
+# =====================================================================
+try:
+    from sentence_transformers import SentenceTransformer
+    import torch
+except ImportError:
+    print("❌ ERRO: As bibliotecas 'torch' ou 'sentence-transformers' não estão instaladas.")
+    print("       Execute: pip install torch sentence-transformers numpy faiss-cpu")
+    sys.exit(1)
+
+# Núcleos da CPU não reservados ao FAISS (ConfiguracaoThreads.py) para o PyTorch (geração de embeddings)
+torch.set_num_threads(NUM_THREADS_TORCH)
+
+# Intel Extension for PyTorch (opcional): habilita BF16 otimizado em CPUs com AMX/AVX-512-BF16
+try:
+    import intel_extension_for_pytorch as ipex
+except ImportError:
+    ipex = None
+
+# ONNX Runtime via Optimum (opcional): inferência do MiniLM 2-4x mais rápida em CPU
+try:
+    from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTOptimizer, ORTQuantizer
+    from optimum.onnxruntime.configuration import AutoOptimizationConfig, AutoQuantizationConfig
+    from transformers import AutoTokenizer
+except ImportError:
+    ORTModelForFeatureExtraction = None
+
+# BetterTransformer via Optimum (opcional): kernels de atenção "fastpath" do PyTorch
+try:
+    from optimum.bettertransformer import BetterTransformer
+except ImportError:
+    BetterTransformer = None
+
+# Numba (opcional): compila a normalização L2 das linhas dos embeddings
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+# ATENÇÃO: É VITAL USAR O MESMO MODELO PARA CRIAR O ÍNDICE E PARA BUSCAR NELE!
+NOME_MODELO_EMBEDDING = 'all-MiniLM-L6-v2'
+
+# Diretório do modelo exportado para ONNX (gerado com: python ModeloEmbedding.py --exportar-onnx)
+DIRETORIO_MODELO_ONNX = 'minilm_onnx'
+ARQUIVO_MODELO_ONNX_QUANTIZADO = 'model_optimized_quantized.onnx'
+MAX_TOKENS_ONNX = 256  # Mesmo max_seq_length do all-MiniLM-L6-v2 no sentence-transformers
+
+
+if njit is not None:
+    # Sequencial: o pool de threads do numba disputaria os núcleos já divididos
+    # entre torch e FAISS (ConfiguracaoThreads); a normalização é limitada pela memória
+    @njit(fastmath=True, cache=True)
+    def _normalizar_linhas_l2(x: np.ndarray) -> np.ndarray:
+        """
+        Normaliza (in-place) cada linha de 'x' para norma L2 unitária.
+        """
+        for i in range(x.shape[0]):
+            norma = 0.0
+            for j in range(x.shape[1]):
+                norma += x[i, j] * x[i, j]
+            norma = max(np.sqrt(norma), 1e-12)
+            for j in range(x.shape[1]):
+                x[i, j] /= norma
+        return x
+else:
+    def _normalizar_linhas_l2(x: np.ndarray) -> np.ndarray:
+        """
+        Normaliza (in-place) cada linha de 'x' para norma L2 unitária (NumPy vetorizado).
+        """
+        x /= np.maximum(np.linalg.norm(x, axis=1, keepdims=True), 1e-12)
+        return x
+
+
+class ModeloEmbeddingONNX:
+    """
+    Encapsula o MiniLM exportado para ONNX Runtime com a mesma interface
+    'encode' do SentenceTransformer (mean pooling + normalização L2).
+    """
+
+    def __init__(self, diretorio: str):
+        self.tokenizer = AutoTokenizer.from_pretrained(diretorio)
+        arquivo = ARQUIVO_MODELO_ONNX_QUANTIZADO if os.path.exists(os.path.join(diretorio, ARQUIVO_MODELO_ONNX_QUANTIZADO)) else None
+        self.modelo = ORTModelForFeatureExtraction.from_pretrained(
+            diretorio,
+            file_name=arquivo,
+            provider="CPUExecutionProvider"
+        )
+
+    def encode(self, textos: List[str], batch_size: int = 32, **kwargs) -> np.ndarray:
+        lotes = []
+        for inicio in range(0, len(textos), batch_size):
+            entradas = self.tokenizer(
+                textos[inicio:inicio + batch_size],
+                padding=True,
+                truncation=True,
+                max_length=MAX_TOKENS_ONNX,
+                return_tensors="np"
+            )
+            tokens = self.modelo(**entradas).last_hidden_state
+
+            # Mean pooling considerando apenas os tokens válidos (attention mask)
+            mascara = entradas["attention_mask"][..., np.newaxis].astype(np.float32)
+            soma = (tokens * mascara).sum(axis=1)
+            embeddings = soma / np.clip(mascara.sum(axis=1), 1e-9, None)
+
+            # Normalização L2 (equivalente à camada Normalize do sentence-transformers)
+            lotes.append(_normalizar_linhas_l2(embeddings.astype(np.float32)))
+
+        return np.concatenate(lotes) if lotes else np.empty((0, 0), dtype=np.float32)
+
+
+def exportar_modelo_onnx(diretorio: str = DIRETORIO_MODELO_ONNX):
+    """
+    Exporta o MiniLM para ONNX, aplica as otimizações de grafo (O3) e a
+    quantização dinâmica INT8. Execução única: o resultado fica em 'diretorio'.
+    """
+    nome_hub = f"sentence-transformers/{NOME_MODELO_EMBEDDING}"
+    modelo = ORTModelForFeatureExtraction.from_pretrained(nome_hub, export=True)
+    AutoTokenizer.from_pretrained(nome_hub).save_pretrained(diretorio)
+
+    # 1. Otimização do grafo (fusões de atenção/LayerNorm/GELU)
+    ORTOptimizer.from_pretrained(modelo).optimize(
+        save_dir=diretorio,
+        optimization_config=AutoOptimizationConfig.O3()
+    )
+
+    # 2. Quantização dinâmica INT8 do modelo otimizado
+    quantizador = ORTQuantizer.from_pretrained(diretorio, file_name="model_optimized.onnx")
+    quantizador.quantize(
+        save_dir=diretorio,
+        quantization_config=AutoQuantizationConfig.avx2(is_static=False, per_channel=False)
+    )
+    print(f"✅ Modelo ONNX otimizado e quantizado salvo em: {diretorio}")
+
+
+def carregar_modelo_embedding():
+    """
+    Carrega o MiniLM no dispositivo disponível e reduz a precisão quando suportado:
+    FP16 em GPU (tensor cores) e BF16 em CPU Intel (via IPEX).
+    Se o modelo ONNX já tiver sido exportado (e o Optimum estiver instalado),
+    ele é usado no lugar do PyTorch em CPU.
+    Retorna uma tupla (modelo, device, precisao).
+    """
+    if (ORTModelForFeatureExtraction is not None
+            and os.path.isdir(DIRETORIO_MODELO_ONNX)
+            and not torch.cuda.is_available()):
+        return ModeloEmbeddingONNX(DIRETORIO_MODELO_ONNX), "cpu", "onnx"
+
+    modelo = SentenceTransformer(NOME_MODELO_EMBEDDING)
+
+    # Define o dispositivo de execução (importante para performance)
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    modelo.to(device)
+
+    usar_ipex = device == "cpu" and ipex is not None
+
+    # BetterTransformer (atenção fundida); o IPEX já aplica as próprias fusões
+    if BetterTransformer is not None and not usar_ipex:
+        try:
+            modelo[0].auto_model = BetterTransformer.transform(modelo[0].auto_model)
+        except Exception as e:
+            # Versões recentes do optimum/transformers descontinuam o BetterTransformer
+            # (ou o recusam em modelos com SDPA nativo): segue com o modelo original
+            print(f"⚠️ BetterTransformer indisponível para este modelo ({e}); usando o modelo original.")
+
+    if device == "cuda":
+        modelo.half()
+        precisao = "float16"
+    elif usar_ipex:
+        modelo[0].auto_model = ipex.optimize(modelo[0].auto_model.eval(), dtype=torch.bfloat16)
+        precisao = "bfloat16"
+    else:
+        # Sem IPEX, o BF16 em CPU tende a ser emulado (mais lento): mantém FP32
+        precisao = "float32"
+
+    # torch.compile (PyTorch >= 2.0) em GPU. Modo padrão (sem CUDA Graphs) e
+    # dynamic=True: o tamanho do lote e o comprimento das sequências variam a
+    # cada chamada, e formas fixas recompilariam o grafo a cada nova forma
+    if device == "cuda" and hasattr(torch, "compile"):
+        modelo[0].auto_model = torch.compile(modelo[0].auto_model, dynamic=True)
+
+    return modelo, device, precisao
+
+
+# 🌟 MODELO BERT LEVE 🌟
+# Executado como script (--exportar-onnx), o módulo só exporta: o modelo PyTorch
+# não é carregado nem aquecido.
+if __name__ != "__main__":
+    MODELO_EMBEDDING, DEVICE, PRECISAO = carregar_modelo_embedding()
+    print(f"✅ Modelo de Embedding ({NOME_MODELO_EMBEDDING}) carregado no dispositivo: {DEVICE} ({PRECISAO})")
+
+
+def gerar_embeddings(textos: List[str], modelo=None, **kwargs) -> np.ndarray:
+    """
+    Gera os embeddings dos textos com o modelo informado (por padrão, o
+    modelo compartilhado do processo).
+    O resultado é sempre float32, o tipo esperado pelo FAISS.
+    """
+    modelo = modelo if modelo is not None else MODELO_EMBEDDING
+    if PRECISAO == "bfloat16":
+        with torch.autocast("cpu", dtype=torch.bfloat16):
+            embeddings = modelo.encode(textos, convert_to_numpy=True, **kwargs)
+    else:
+        embeddings = modelo.encode(textos, convert_to_numpy=True, **kwargs)
+
+    # Converte de volta para float32 apenas na fronteira com o FAISS
+    return embeddings.astype('float32', copy=False)
+
+
+def gerar_embeddings_corpus(textos: List[str], modelo=None, **kwargs) -> np.ndarray:
+    """
+    Gera os embeddings de um corpus inteiro (muitos textos).
+    Com mais de uma GPU, distribui os lotes entre os dispositivos com o pool
+    multiprocesso do sentence-transformers; caso contrário, usa lotes maiores
+    no dispositivo atual.
+    """
+    modelo = modelo if modelo is not None else MODELO_EMBEDDING
+    if isinstance(modelo, SentenceTransformer) and torch.cuda.device_count() > 1:
+        pool = modelo.start_multi_process_pool()
+        try:
+            embeddings = modelo.encode_multi_process(textos, pool, batch_size=64, **kwargs)
+        finally:
+            modelo.stop_multi_process_pool(pool)
+        return embeddings.astype('float32', copy=False)
+
+    return gerar_embeddings(textos, modelo=modelo, batch_size=128, **kwargs)
+
+
+# Aquecimento: dispara a compilação/alocação na carga, fora da latência da primeira busca
+if __name__ != "__main__":
+    gerar_embeddings(["aquecimento"])
+
+
+if __name__ == "__main__":
+    if "--exportar-onnx" not in sys.argv[1:]:
+        print("Uso: python ModeloEmbedding.py --exportar-onnx")
+        sys.exit(1)
+
+    if ORTModelForFeatureExtraction is None:
+        print("❌ ERRO: A biblioteca 'optimum[onnxruntime]' não está instalada.")
+        print("       Execute: pip install optimum[onnxruntime]")
+        sys.exit(1)
+
+    exportar_modelo_onnx()